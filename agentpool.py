@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+import random
+import time
+import logging
+import multiprocessing
+
+from messages import PeerInfo
+from history import History
+from swarm import ENGINES
+from util import derive_seed
+from views import OthersView, SwarmView
+from peer import batch_groups, UploadInputs
+
+
+class AgentPool:
+    """
+    Runs the agents' requests() and uploads() calls in long-lived worker
+    processes, for --agent-workers.
+
+    Each worker owns a share of the agents for the whole simulation, along
+    with its own copies of the swarm state and the history.  It keeps those
+    in step from each round's downloads and uploads.  So all that crosses
+    process boundaries each round is:
+      - to each worker: the Requests addressed to its agents, and the
+        round's DownloadBatch and Uploads;
+      - back from it: its agents' Requests and Uploads.
+    The agents see exactly what they would in the sim's own process, except
+    for agents that use the random module directly instead of self.random.
+
+    The sim still validates everything the agents return.
+    """
+    def __init__(self, n, peers, pieces, upload_rates, conf, window, seed):
+        """
+        n: number of worker processes
+        peers: the agents, in sim order.  The workers get their own copies,
+            so these must not have started playing yet.
+        pieces: dict : peer_id -> [blocks / piece] at the start
+        window: History window, as in the sim
+        """
+        peer_ids = [p.id for p in peers]
+        self.workers = []
+        for i in range(min(n, len(peers))):
+            (conn, child_conn) = multiprocessing.Pipe()
+            args = (child_conn, peers[i::n], peer_ids, pieces, upload_rates,
+                    conf, window, derive_seed(seed, "agent worker", i))
+            proc = multiprocessing.Process(target=agent_worker, args=args)
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self.workers.append((conn, proc, [p.id for p in peers[i::n]]))
+
+    def call(self, method, args_for):
+        """
+        Run method on every worker.  args_for(peer_ids) gives the arguments
+        for a worker that owns peer_ids.  Returns dict : peer_id -> (output,
+        wall seconds the agent's call took, cpu seconds it took).
+        """
+        for (conn, proc, ids) in self.workers:
+            conn.send((method, args_for(ids)))
+        results = dict()
+        for (conn, proc, ids) in self.workers:
+            (ok, value) = conn.recv()
+            if not ok:
+                raise value
+            results.update(value)
+        return results
+
+    def requests(self):
+        """Every agent's requests() for this round."""
+        return self.call("requests", lambda ids: ())
+
+    def uploads(self, inbox):
+        """Every agent's uploads(), given inbox : peer_id -> [Requests to
+        that peer]."""
+        return self.call("uploads", lambda ids: (
+            dict((pid, inbox[pid]) for pid in ids),))
+
+    def update(self, downloads, uploads):
+        """Apply the round's downloads and uploads to every worker's copy of
+        the state and history.  Doesn't wait for the workers."""
+        for (conn, proc, ids) in self.workers:
+            conn.send(("update", (downloads, uploads)))
+
+    def close(self):
+        for (conn, proc, ids) in self.workers:
+            try:
+                conn.send(("stop", ()))
+            except (IOError, EOFError):
+                pass
+            conn.close()
+        for (conn, proc, ids) in self.workers:
+            proc.join()
+        self.workers = []
+
+
+def agent_worker(conn, peers, peer_ids, pieces, upload_rates, conf, window,
+                 seed):
+    """Worker process main loop: serves the AgentPool's calls for peers
+    until told to stop."""
+    # For agents that still use the random module directly.
+    random.seed(seed)
+    state = ENGINES[conf.engine](conf.blocks_per_piece, pieces)
+    swarm = SwarmView(state)
+    for p in peers:
+        p.swarm = swarm
+    history = History(peer_ids, upload_rates, window,
+                      conf.history_window is not None, None)
+    position = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+    batches = dict((m, batch_groups(peers, m)) for m in ("requests", "uploads"))
+
+    def round_info():
+        peer_info = [PeerInfo(pid, state.available_snapshot(pid),
+                              state.available_mask(pid))
+                     for pid in peer_ids]
+        h = dict((p.id, history.peer_history(p.id)) for p in peers)
+        return (peer_info, h)
+
+    def timed(f, *args):
+        (wall, cpu) = (time.time(), time.clock())
+        out = f(*args)
+        return (out, time.time() - wall, time.clock() - cpu)
+
+    def others(p):
+        return OthersView(peer_info, position[p.id])
+
+    def batched(method, args_for):
+        """Call the batch_<method> hooks, as the sim does.  Each agent is
+        charged the batch's average time per agent."""
+        results = dict()
+        for (agent_class, agents) in batches[method]:
+            hook = getattr(agent_class, "batch_" + method)
+            # Timed along with putting its inputs together.
+            (outs, wall, cpu) = timed(
+                lambda: hook(agents, *args_for(agents)))
+            for (p, out) in zip(agents, outs):
+                results[p.id] = (out, wall / len(agents), cpu / len(agents))
+        return results
+
+    def requests():
+        for p in peers:
+            p.update_pieces(state.pieces_view(p.id), state.pop_changed(p.id))
+        results = batched("requests", lambda agents: (
+            [others(p) for p in agents], [h[p.id] for p in agents]))
+        for p in peers:
+            if p.id not in results:
+                results[p.id] = timed(p.requests, others(p), h[p.id])
+        return results
+
+    def uploads(inbox):
+        results = batched("uploads", lambda agents: (UploadInputs(
+            [inbox[p.id] for p in agents], [others(p) for p in agents],
+            [h[p.id] for p in agents], history),))
+        for p in peers:
+            if p.id not in results:
+                results[p.id] = timed(p.uploads, inbox[p.id], others(p), h[p.id])
+        return results
+
+    (peer_info, h) = round_info()
+    try:
+        while True:
+            (method, args) = conn.recv()
+            if method == "stop":
+                break
+            if method == "update":
+                (downloads, ups) = args
+                state.apply(downloads)
+                history.update(downloads, ups)
+                (peer_info, h) = round_info()
+                continue
+            try:
+                f = requests if method == "requests" else uploads
+                conn.send((True, f(*args)))
+            except Exception, e:
+                logging.exception("Agent worker failed in %s()", method)
+                conn.send((False, e))
+    finally:
+        history.close()
+        conn.close()
@@ -6,7 +6,6 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 
 from messages import Upload, Request
@@ -45,8 +44,10 @@ class Dummy(Peer):
         logging.debug(str(history))
 
         requests = []   # We'll put all the things we want here
-        # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        # Symmetry breaking is good...  Use self.random, this peer's own
+        # seeded random stream, rather than the random module so runs can
+        # be reproduced with --seed.
+        self.random.shuffle(needed_pieces)
         
         # Sort peers by id.  This is probably not a useful sort, but other 
         # sorts might be useful
@@ -60,7 +61,9 @@ class Dummy(Peer):
             # More symmetry breaking -- ask for random pieces.
             # This would be the place to try fancier piece-requesting strategies
             # to avoid getting the same thing from multiple peers at a time.
-            for piece_id in random.sample(isect, n):
+            # Sample from a sorted list: a set's iteration order depends on
+            # how it was built, and the draws shouldn't.
+            for piece_id in self.random.sample(sorted(isect), n):
                 # aha! The peer has this piece! Request it.
                 # which part of the piece do we need next?
                 # (must get the next-needed blocks in order)
@@ -87,7 +90,8 @@ class Dummy(Peer):
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
-        # the previous round.
+        # the previous round.  history.received_from(round-1) has the same
+        # thing already totalled up per peer: {peer_id: blocks}.
 
         if len(requests) == 0:
             logging.debug("No one wants my pieces!")
@@ -98,7 +102,7 @@ class Dummy(Peer):
             # change my internal state for no reason
             self.dummy_state["cake"] = "pie"
 
-            request = random.choice(requests)
+            request = self.random.choice(requests)
             chosen = [request.requester_id]
             # Evenly "split" my upload bandwidth among the one chosen requester
             bws = even_split(self.up_bw, len(chosen))
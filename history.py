@@ -2,6 +2,13 @@
 
 import copy
 import pprint
+import os
+import shutil
+import tempfile
+import collections
+from array import array
+
+from messages import Download, Upload
 
 
 class AgentHistory:
@@ -9,19 +16,49 @@ class AgentHistory:
     History available to a single peer
 
     history.downloads: [[Download objects for round]]  (one sublist for each round)
-         All the downloads _to_ this agent.
+         All the downloads _to_ this agent.  Each round reads like a list,
+         but is a DownloadList view of the round's DownloadBatch: the
+         Download objects are made as they're read.
         
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
+
+    history.received: [{peer_id: blocks}]  (one dict for each round)
+         Blocks this agent downloaded from each peer, summed over pieces.
+
+    history.sent: [{peer_id: bw}]  (one dict for each round)
+         Bandwidth this agent uploaded to each peer.
+
+    The received and sent dicts are computed once per round by History and
+    shared, so read them but don't change them.
     """
-    def __init__(self, peer_id, downloads, uploads):
+    def __init__(self, peer_id, downloads, uploads, received, sent):
         """
         Pull out just the info for peer_id.
         """
         self.uploads = uploads
         self.downloads = downloads
+        self.received = received
+        self.sent = sent
         self.peer_id = peer_id
 
+    def received_from(self, r):
+        """dict : peer_id -> blocks downloaded from that peer in round r"""
+        return self.received[r]
+
+    def uploaded_to(self, r):
+        """dict : peer_id -> bandwidth uploaded to that peer in round r"""
+        return self.sent[r]
+
+    def received_in_last(self, n):
+        """dict : peer_id -> blocks downloaded from that peer over the last
+        n rounds (or all of them, if fewer have been played)"""
+        totals = dict()
+        for r in range(max(0, self.current_round() - n), self.current_round()):
+            for (peer_id, blocks) in self.received[r].items():
+                totals[peer_id] = totals.get(peer_id, 0) + blocks
+        return totals
+
     def last_round(self):
         return len(self.downloads)-1
 
@@ -31,13 +68,201 @@ class AgentHistory:
 
     def __repr__(self):
         return "AgentHistory(downloads=%s, uploads=%s)" % (
-            pprint.pformat(self.downloads),
-            pprint.pformat(self.uploads))
+            pformat_rounds(self.downloads),
+            pformat_rounds(self.uploads))
+
+
+class RoundLog(object):
+    """
+    One peer's per-round lists (of downloads or uploads), indexed by round
+    number like a plain list.  Only the last window rounds are kept in
+    memory, as a ring buffer; older ones are read back with fetch(round),
+    or are gone if fetch is None.
+    """
+    def __init__(self, window, fetch):
+        self.window = window
+        self.fetch = fetch
+        self.recent = collections.deque()
+        self.first = 0   # round number of recent[0]
+
+    def append(self, lst):
+        self.recent.append(lst)
+        if len(self.recent) > self.window:
+            self.recent.popleft()
+            self.first += 1
+
+    def __len__(self):
+        return self.first + len(self.recent)
+
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self[i] for i in range(*r.indices(len(self)))]
+        if r < 0:
+            r += len(self)
+        if r < 0 or r >= len(self):
+            raise IndexError("round %d is not in the history" % r)
+        if r >= self.first:
+            return self.recent[r - self.first]
+        if self.fetch is None:
+            raise IndexError("round %d is older than the last %d rounds kept"
+                             % (r, self.window))
+        return self.fetch(r)
+
+    def __iter__(self):
+        for r in range(len(self)):
+            yield self[r]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class HistoryLog:
+    """
+    Columnar on-disk log of every round's downloads and uploads.
+
+    Each column is a flat file of numbers (peers are stored by their index
+    in peer_ids).  A round's records are appended to all of a table's
+    columns at once, and round_starts remembers where each round starts, so
+    any one round can be read back with a seek per column.
+    """
+    # column name -> array typecode.  owner is the peer whose list the
+    # record was in.
+    DOWNLOAD_COLUMNS = [("owner", "i"), ("from_id", "i"), ("to_id", "i"),
+                        ("piece", "i"), ("blocks", "d")]
+    UPLOAD_COLUMNS = [("owner", "i"), ("from_id", "i"), ("to_id", "i"),
+                      ("bw", "d")]
+
+    def __init__(self, peer_ids, directory=None):
+        """
+        directory: where to put the log.  If None, use a temporary
+        directory that close() removes.
+        """
+        self.peer_ids = peer_ids[:]
+        self.index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.is_temporary = directory is None
+        if self.is_temporary:
+            self.directory = tempfile.mkdtemp(prefix="history-")
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.directory = tempfile.mkdtemp(prefix="history-", dir=directory)
+
+        def open_columns(table, columns):
+            return [(typecode, open(os.path.join(
+                        self.directory, "%s.%s" % (table, name)), "w+b"))
+                    for (name, typecode) in columns]
+
+        self.columns = {
+            "downloads": open_columns("downloads", self.DOWNLOAD_COLUMNS),
+            "uploads": open_columns("uploads", self.UPLOAD_COLUMNS),
+        }
+        # table -> [record offset of each round, then the total]
+        self.round_starts = {"downloads": [0], "uploads": [0]}
+
+    def append_round(self, dls, ups):
+        """Same arguments as History.update"""
+        ix = self.index
+
+        # The download columns come straight from the batch.  A download's
+        # owner is the peer it went to.
+        to_ix = map(ix.__getitem__, dls.to_id)
+        self.write("downloads", [to_ix, map(ix.__getitem__, dls.from_id),
+                                 to_ix, dls.piece, dls.blocks])
+
+        def rows(lists, fields):
+            for pid in self.peer_ids:
+                for m in lists[pid]:
+                    yield (ix[pid],) + fields(m)
+
+        self.write("uploads", zip(*rows(
+            ups, lambda u: (ix[u.from_id], ix[u.to_id], u.bw))))
+
+    def write(self, table, columns):
+        """columns: one sequence per column of table, all the same length
+        (or none at all, for an empty round)."""
+        starts = self.round_starts[table]
+        count = len(columns[0]) if columns else 0
+        for (i, (typecode, f)) in enumerate(self.columns[table]):
+            if count > 0:
+                f.seek(0, os.SEEK_END)
+                array(typecode, columns[i]).tofile(f)
+        starts.append(starts[-1] + count)
+
+    def read(self, table, r):
+        """The columns of round r of table, as arrays."""
+        starts = self.round_starts[table]
+        (start, count) = (starts[r], starts[r + 1] - starts[r])
+        cols = []
+        for (typecode, f) in self.columns[table]:
+            a = array(typecode)
+            if count > 0:
+                f.seek(start * a.itemsize)
+                a.fromfile(f, count)
+            cols.append(a)
+        return cols
+
+    def downloads(self, peer_id, r):
+        """Downloads _to_ peer_id in round r"""
+        ids = self.peer_ids
+        me = self.index[peer_id]
+        (owner, from_id, to_id, piece, blocks) = self.read("downloads", r)
+        return [Download(ids[from_id[i]], ids[to_id[i]], piece[i],
+                         as_number(blocks[i]))
+                for i in range(len(owner)) if owner[i] == me]
+
+    def uploads(self, peer_id, r):
+        """Uploads _from_ peer_id in round r"""
+        ids = self.peer_ids
+        me = self.index[peer_id]
+        (owner, from_id, to_id, bw) = self.read("uploads", r)
+        return [Upload(ids[from_id[i]], ids[to_id[i]], as_number(bw[i]))
+                for i in range(len(owner)) if owner[i] == me]
+
+    def close(self):
+        for columns in self.columns.values():
+            for (typecode, f) in columns:
+                f.close()
+        if self.is_temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def pformat_rounds(rounds):
+    """pprint.pformat for a list of rounds or a RoundLog, skipping rounds
+    that were dropped.  Each round is printed as a plain list."""
+    if isinstance(rounds, RoundLog) and rounds.fetch is None and rounds.first > 0:
+        return "<rounds 0-%d not kept> %s" % (
+            rounds.first - 1, pprint.pformat(map(list, rounds.recent)))
+    return pprint.pformat(map(list, rounds))
+
+
+def blocks_by_sender(downloads):
+    """dict : from_id -> total blocks in downloads"""
+    totals = dict()
+    for d in downloads:
+        totals[d.from_id] = totals.get(d.from_id, 0) + d.blocks
+    return totals
+
+
+def bw_by_receiver(uploads):
+    """dict : to_id -> total bandwidth in uploads"""
+    totals = dict()
+    for u in uploads:
+        totals[u.to_id] = totals.get(u.to_id, 0) + u.bw
+    return totals
+
+
+def as_number(x):
+    """Blocks and bandwidths are logged as doubles; give back ints where
+    that's what they were."""
+    if x == int(x):
+        return int(x)
+    return x
 
 
 class History:
     """History of the whole sim"""
-    def __init__(self, peer_ids, upload_rates):
+    def __init__(self, peer_ids, upload_rates, window=None,
+                 log_to_disk=False, log_dir=None):
         """
         uploads:
                    dict : peer_id -> [[uploads] -- one list per round]
@@ -46,24 +271,89 @@ class History:
                    
         Keep track of the uploads _from_ and downloads _to_ the
         specified peer id.
+
+        window: if given, only the last window rounds are kept in memory,
+        and uploads and downloads hold RoundLogs instead of lists.
+        log_to_disk: with a window, also append every round to a HistoryLog
+        on disk (in log_dir, or a temporary directory) and read older rounds
+        back from it.  Otherwise older rounds are dropped.
+
+        received:
+                   dict : peer_id -> [{sender: blocks} -- one dict per round]
+        sent:
+                   dict : peer_id -> [{receiver: bw} -- one dict per round]
+        Per-round totals, worked out once in update() for every agent to
+        use.  Kept for the same rounds as uploads and downloads.
+
+        Running aggregates, kept up to date by update() so that Stats never
+        has to go back over old rounds:
+        uploaded: dict : peer_id -> total blocks uploaded so far.
+        throughput: [blocks downloaded by the whole swarm -- one per round]
+        round_done: dict : peer_id -> round the peer finished in.
         """
         self.upload_rates = upload_rates  # peer_id -> up_bw
         self.peer_ids = peer_ids[:]
+        # peer_id -> its position in peer_ids
+        self.index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.window = window
 
         self.round_done = dict()   # peer_id -> round finished
-        self.downloads = dict((pid, []) for pid in peer_ids)
-        self.uploads = dict((pid, []) for pid in peer_ids)
+        self.uploaded = dict((pid, 0) for pid in peer_ids)
+        self.throughput = []
+        self.log = None
+        if window is None:
+            self.downloads = dict((pid, []) for pid in peer_ids)
+            self.uploads = dict((pid, []) for pid in peer_ids)
+            self.received = dict((pid, []) for pid in peer_ids)
+            self.sent = dict((pid, []) for pid in peer_ids)
+        else:
+            if log_to_disk:
+                self.log = HistoryLog(peer_ids, log_dir)
+
+            def round_log(table, pid, f=lambda x: x):
+                """Rounds of f(table entries for pid)"""
+                if self.log is None:
+                    return RoundLog(window, None)
+                fetch = getattr(self.log, table)
+                return RoundLog(window, lambda r: f(fetch(pid, r)))
+
+            self.downloads = dict((pid, round_log("downloads", pid))
+                                  for pid in peer_ids)
+            self.uploads = dict((pid, round_log("uploads", pid))
+                                for pid in peer_ids)
+            self.received = dict(
+                (pid, round_log("downloads", pid, blocks_by_sender))
+                for pid in peer_ids)
+            self.sent = dict((pid, round_log("uploads", pid, bw_by_receiver))
+                             for pid in peer_ids)
 
     def update(self, dls, ups):
         """
-        dls: dict : peer_id -> [downloads] -- downloads for this round
+        dls: DownloadBatch -- downloads for this round
         ups: dict : peer_id -> [uploads] -- uploads for this round
 
-        append these downloads to to the history
+        append these downloads to to the history.  The batch is read by
+        column; each peer's downloads are kept as a view of it.
         """
+        if self.log is not None:
+            self.log.append_round(dls, ups)
+        self.throughput.append(0)
+        received_by_peer = dls.received()
         for pid in self.peer_ids:
-            self.downloads[pid].append(dls[pid])
+            self.downloads[pid].append(dls.to(pid))
             self.uploads[pid].append(ups[pid])
+            received = received_by_peer.get(pid, dict())
+            self.received[pid].append(received)
+            self.sent[pid].append(bw_by_receiver(ups[pid]))
+            for (sender, blocks) in received.items():
+                self.uploaded[sender] += blocks
+                self.throughput[-1] += blocks
+
+    def close(self):
+        """Release the on-disk log, if any.  Rounds outside the window can't
+        be read after this."""
+        if self.log is not None:
+            self.log.close()
 
     def peer_is_done(self, round, peer_id):
         # Only save the _first_ round where we hear this
@@ -71,33 +361,40 @@ class History:
             self.round_done[peer_id] = round
 
     def peer_history(self, peer_id):
-        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id])
+        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id],
+                            self.received[peer_id], self.sent[peer_id])
 
     def last_round(self):
         """index of the last completed round"""
         p = self.peer_ids[0]
         return len(self.downloads[p])-1
 
+    def first_round(self):
+        """index of the oldest round that can still be read"""
+        if self.window is None or self.log is not None:
+            return 0
+        return max(0, self.last_round() + 1 - self.window)
+
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
+        lines = ["\nRound %s:" % r]
         for peer_id in self.peer_ids:
-            ds = self.downloads[peer_id][r]
-            stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
-                peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+            for d in self.downloads[peer_id][r]:
+                lines.append("%s downloaded %d blocks of piece %d from %s" % (
+                    peer_id, d.blocks, d.piece, d.from_id))
+        return "\n".join(lines)
 
     def pretty(self):
-        s = "History\n"
-        for r in range(self.last_round()+1):
-            s += self.pretty_for_round(r)
-        return s
+        return "History\n" + "\n".join(self.pretty_for_round(r)
+                                         for r in range(self.first_round(),
+                                                        self.last_round()+1))
 
     def __repr__(self):
         return """History(
 uploads=%s
 downloads=%s
 )""" % (
-    pprint.pformat(self.uploads),
-    pprint.pformat(self.downloads))
+    "\n".join("%s: %s" % (pid, pformat_rounds(self.uploads[pid]))
+              for pid in self.peer_ids),
+    "\n".join("%s: %s" % (pid, pformat_rounds(self.downloads[pid]))
+              for pid in self.peer_ids))
 
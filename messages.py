@@ -1,6 +1,30 @@
 #!/usr/bin/python
 
-class Upload:
+from array import array
+from itertools import izip
+
+from util import to_mask
+
+
+class Message(object):
+    """
+    Base for the message types.  Their attributes are fixed in __slots__,
+    so a message has no per-object __dict__: a big run makes millions of
+    them.  Setting any other attribute on one is an AttributeError.
+    """
+    __slots__ = ()
+
+    # Slotted objects only pickle by default with protocol 2.
+    def __getstate__(self):
+        return tuple(getattr(self, a) for a in self.__slots__)
+
+    def __setstate__(self, state):
+        for (a, v) in zip(self.__slots__, state):
+            setattr(self, a, v)
+
+class Upload(Message):
+    __slots__ = ("from_id", "to_id", "bw")
+
     def __init__(self, from_id, to_id, up_bw):
         self.from_id = from_id
         self.to_id = to_id
@@ -10,7 +34,9 @@ class Upload:
         return "Upload(from_id = %s, to_id=%s, bw=%d)" % (
             self.from_id, self.to_id, self.bw)
 
-class Request:
+class Request(Message):
+    __slots__ = ("requester_id", "peer_id", "piece_id", "start")
+
     def __init__(self, requester_id, peer_id, piece_id, start):
         self.requester_id = requester_id
         self.peer_id = peer_id   # peer data is requested from
@@ -21,10 +47,12 @@ class Request:
         return "Request(requester_id=%s, peer_id=%s, piece_id=%d, start=%d)" % (
             self.requester_id, self.peer_id, self.piece_id, self.start)
 
-class Download:
+class Download(Message):
     """ Not actually a message--just used for accounting and history tracking of
      what is actually downloaded.
     """
+    __slots__ = ("from_id", "to_id", "piece", "blocks")
+
     def __init__(self, from_id, to_id, piece, blocks):
         self.from_id = from_id  # who did the agent download from?
         self.to_id = to_id      # Who downloaded?
@@ -35,14 +63,123 @@ class Download:
         return "Download(from_id=%s, to_id=%s, piece=%d, blocks=%d)" % (
             self.from_id, self.to_id, self.piece, self.blocks)
 
-class PeerInfo:
+class PeerInfo(Message):
     """
     Only passing peer ids and the pieces they have available to each agent.
     This prevents them from accidentally messing up the state of other agents.
+    The sim passes available as a frozenset, so it can be shared between
+    agents without copying.
+
+    available_mask is the same set as a bitmask (bit i set if piece i is
+    available), for fast interest checks:
+        popcount(self.needed_mask() & peer.available_mask)
     """
-    def __init__(self, id, available):
+    __slots__ = ("id", "available_pieces", "available_mask")
+
+    def __init__(self, id, available, mask=None):
         self.id = id
         self.available_pieces = available
+        if mask is None:
+            mask = to_mask(available)
+        self.available_mask = mask
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
+
+
+class DownloadBatch(object):
+    """
+    One round's Downloads, stored as parallel columns instead of one object
+    per download: from_id, to_id and blocks are lists (blocks can be
+    fractional if an agent uploads at a fractional rate), and piece is an
+    array of C longs.  The sim builds one per round, and the engines and
+    History read the columns directly.
+
+    Downloads to the same peer are kept together, so each peer's share is
+    one slice of the columns.  to(peer_id) gives it as a DownloadList, which
+    only makes Download objects if someone reads it.
+    """
+    def __init__(self):
+        self.from_id = []
+        self.to_id = []
+        self.piece = array("l")
+        self.blocks = []
+        self.spans = dict()   # to_id -> (start, end) in the columns
+
+    def add(self, from_id, to_id, piece, blocks):
+        """Add a download.  A peer's downloads must be added one after
+        another."""
+        n = len(self.to_id)
+        span = self.spans.get(to_id)
+        if span is None:
+            self.spans[to_id] = (n, n + 1)
+        elif span[1] == n:
+            self.spans[to_id] = (span[0], n + 1)
+        else:
+            raise ValueError("Downloads to %s weren't added together" % to_id)
+        self.from_id.append(from_id)
+        self.to_id.append(to_id)
+        self.piece.append(piece)
+        self.blocks.append(blocks)
+
+    def __len__(self):
+        return len(self.to_id)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.download(i)
+
+    def download(self, i):
+        return Download(self.from_id[i], self.to_id[i], self.piece[i],
+                        self.blocks[i])
+
+    def to(self, peer_id):
+        """DownloadList of the downloads _to_ peer_id."""
+        (start, end) = self.spans.get(peer_id, (0, 0))
+        return DownloadList(self, start, end)
+
+    def received(self):
+        """dict : to_id -> {from_id: blocks}, summed over pieces."""
+        totals = dict()
+        for (to_id, (start, end)) in self.spans.iteritems():
+            by_sender = dict()
+            for (from_id, blocks) in izip(self.from_id[start:end],
+                                          self.blocks[start:end]):
+                by_sender[from_id] = by_sender.get(from_id, 0) + blocks
+            totals[to_id] = by_sender
+        return totals
+
+    def __repr__(self):
+        return "DownloadBatch(%s)" % list(self)
+
+
+class DownloadList(object):
+    """
+    One peer's downloads in a DownloadBatch, read like a list of Download
+    objects.  Each Download is made when it's read.
+    """
+    __slots__ = ("batch", "start", "end")
+
+    def __init__(self, batch, start, end):
+        self.batch = batch
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("list index out of range")
+        return self.batch.download(self.start + i)
+
+    def __iter__(self):
+        for i in range(self.start, self.end):
+            yield self.batch.download(i)
+
+    def __repr__(self):
+        return repr(list(self))
@@ -1,16 +1,54 @@
 #!/usr/bin/python
 
 import random
+import inspect
+from array import array
 from messages import Upload, Request
 from util import even_split
 
 class Peer:
-    def __init__(self, config, id, init_pieces, up_bandwidth):
+    # How many past rounds of history this agent looks at.  None means it may
+    # look at all of them.  With --lookback auto, the sim only keeps as many
+    # rounds as the agents in the run need.
+    history_lookback = None
+
+    # Optional class-level hooks for deciding for all of a class's agents at
+    # once, e.g. with NumPy.  If a class sets one to a classmethod, the sim
+    # calls it once per round with all the agents of that class (in sim
+    # order) instead of calling the per-agent method on each:
+    #
+    #   batch_requests(cls, agents, peers, histories)
+    #   batch_uploads(cls, agents, inputs)
+    #
+    # For batch_requests, peers and histories are lists lined up with
+    # agents, holding what each agent's requests() would get.  For
+    # batch_uploads, inputs is an UploadInputs, which has those lists and
+    # also the round's requests and last round's received totals as
+    # columns.  Return a list of outputs lined up with agents.
+    # update_pieces() has already been called on each agent.  A subclass
+    # that overrides the per-agent method doesn't inherit the hook (see
+    # batch_hook()).
+    batch_requests = None
+    batch_uploads = None
+
+    def __init__(self, config, id, init_pieces, up_bandwidth, rng=None):
         self.conf = config
         self.id = id
         self.pieces = init_pieces[:]
         # bandwidth measured in blocks-per-time-period
         self.up_bw = up_bandwidth
+        # This peer's own random.Random stream, seeded by the sim.  Use it
+        # instead of the random module so runs can be reproduced.
+        if rng is None:
+            rng = random.Random()
+        self.random = rng
+        # SwarmView of which peers hold each piece.  Set by the sim before
+        # the first round.
+        self.swarm = None
+        # needed, completed, partial: sets of piece ids.  Kept up to date
+        # by update_pieces(), so agents can read them without scanning
+        # self.pieces.
+        self.track_pieces(None)
 
         # This is an upper bound on the number of requests to send to
         # each peer -- they can't possibly handle more than this in one round
@@ -24,12 +62,57 @@ class Peer:
             self.__class__.__name__,
             self.id, self.pieces, self.up_bw)
 
-    def update_pieces(self, new_pieces):
+    def update_pieces(self, new_pieces, changed=None):
         """
         Called by the sim when this peer gets new pieces.  Using a function
         so it's easy to add any extra processing...
+
+        new_pieces is a read-only PiecesView of the sim's own row, not a
+        copy.  It stays current, so take list(self.pieces) to remember how
+        it looked this round.
+        changed: ids of the pieces that changed since the last call, or
+        None if not known.
         """
         self.pieces = new_pieces
+        self.track_pieces(changed)
+
+    def track_pieces(self, changed):
+        """Update needed, completed and partial for the pieces in changed,
+        or rebuild them from self.pieces if changed is None."""
+        if changed is None:
+            changed = range(len(self.pieces))
+            self.needed = set()
+            self.completed = set()
+            self.partial = set()
+            self._needed_mask = 0
+        bpp = self.conf.blocks_per_piece
+        for i in changed:
+            blocks = self.pieces[i]
+            if blocks < bpp:
+                self.needed.add(i)
+                self.completed.discard(i)
+                self._needed_mask |= 1 << i
+                if blocks > 0:
+                    self.partial.add(i)
+                else:
+                    self.partial.discard(i)
+            else:
+                self.needed.discard(i)
+                self.completed.add(i)
+                self.partial.discard(i)
+                self._needed_mask &= ~(1 << i)
+
+    def needed_pieces_list(self):
+        """The ids of the pieces this peer still needs, in increasing order."""
+        return sorted(self.needed)
+
+    def needed_mask(self):
+        """
+        Bitmask of the pieces this peer still needs (bit i set if piece i
+        isn't finished).  AND it with a PeerInfo's available_mask to see
+        what that peer has for us.
+        """
+        return self._needed_mask
 
     def requests(self, peers, history):
         return []
@@ -40,3 +123,108 @@ class Peer:
     def post_init(self):
         # Here to be overridden by child classes
         pass
+
+
+def batch_hook(cls, method):
+    """
+    The batch_<method> hook agent class cls should be run with, or None.
+    A hook only counts if it was defined alongside, or below, the <method>
+    the class would otherwise use: a subclass that overrides <method> gets
+    its own <method> called, not a batch hook it inherited.
+
+    >>> class Batched(Peer):
+    ...     def uploads(self, requests, peers, history):
+    ...         return ["batched"]
+    ...     @classmethod
+    ...     def batch_uploads(cls, agents, inputs):
+    ...         return [["batched"] for a in agents]
+    >>> class Quiet(Batched):
+    ...     def uploads(self, requests, peers, history):
+    ...         return []
+    >>> class Renamed(Batched):
+    ...     pass
+    >>> batch_hook(Batched, "uploads") is not None
+    True
+    >>> batch_hook(Renamed, "uploads") is not None
+    True
+    >>> batch_hook(Quiet, "uploads") is None
+    True
+    >>> batch_hook(Quiet, "requests") is None
+    True
+    """
+    hook = "batch_" + method
+    for c in inspect.getmro(cls):
+        if hook in c.__dict__ or method in c.__dict__:
+            if c.__dict__.get(hook) is None:
+                return None
+            return getattr(cls, hook)
+    return None
+
+
+def batch_groups(agents, method):
+    """
+    [(agent class, [its agents, in order])] for the classes among agents
+    that have a batch_<method> hook ("requests" or "uploads"), as
+    batch_hook() decides.
+    """
+    groups = []
+    by_class = dict()
+    hooks = dict()   # class -> its hook, or None
+    for p in agents:
+        cls = p.__class__
+        if cls not in hooks:
+            hooks[cls] = batch_hook(cls, method)
+        if hooks[cls] is None:
+            continue
+        if cls not in by_class:
+            by_class[cls] = []
+            groups.append((cls, by_class[cls]))
+        by_class[cls].append(p)
+    return groups
+
+
+class UploadInputs(object):
+    """
+    What batch_uploads gets for one class's agents.  Peers in the columns
+    are given by their index in ids, and agents by their position in the
+    group.
+
+    requests, peers, histories: lists lined up with the agents, holding
+        what each agent's uploads() would get.
+    request_agent, request_from: one entry per Request, in the order of
+        requests: the agent it was sent to, and the requester.  The sim
+        files each requester's requests in one go, so an agent's requests
+        from the same requester are together.
+    received_agent, received_from, received_blocks: one entry per (agent,
+        peer that uploaded to it last round), with the blocks it got from
+        that peer, summed over pieces.  Empty in the first round.
+
+    The columns are arrays (C longs, and doubles for received_blocks), so
+    np.frombuffer() reads them without copying.
+    """
+    def __init__(self, requests, peers, histories, history):
+        """history: the sim's History, for the ids and their indices."""
+        self.ids = history.peer_ids
+        self.requests = requests
+        self.peers = peers
+        self.histories = histories
+
+        index = history.index
+        self.request_agent = array("l")
+        self.received_agent = array("l")
+        all_requests = []
+        received_from = []
+        received_blocks = []
+        for (i, (rs, h)) in enumerate(zip(requests, histories)):
+            self.request_agent += array("l", [i]) * len(rs)
+            all_requests += rs
+            if h.current_round() == 0:
+                continue
+            received = h.received_from(h.current_round() - 1)
+            self.received_agent += array("l", [i]) * len(received)
+            received_from += received.keys()
+            received_blocks += received.values()
+        self.request_from = array(
+            "l", [index[r.requester_id] for r in all_requests])
+        self.received_from = array("l", map(index.__getitem__, received_from))
+        self.received_blocks = array("d", received_blocks)
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+"""
+Piece selection strategies shared by the agents.
+"""
+
+from messages import Request
+
+
+def rarest_first(peer, peers):
+    """
+    Rarest-first requests for peer, using the swarm's rarity index.
+
+    peer: the requesting Peer.  Uses its random stream, needed pieces,
+        swarm view and max_requests.
+    peers: the PeerInfo list the sim passed to peer.requests().
+
+    Pieces are asked for rarest first.  Ties go to the pieces that are
+    closest to finished, so they can be shared sooner.  Remaining ties go in
+    a random order.  Each piece is asked of every holder, in a random peer
+    order, that hasn't been sent max_requests yet.  Returns a list of
+    Requests.
+
+    This gives exactly the requests of the loop the Rancho agents used to
+    copy, random draws included, but:
+      - pieces are put in buckets by (holder count, blocks missing) instead
+        of fully sorted, and holder lists are only built for pieces that
+        are reached;
+      - peers that have had max_requests drop out of the holder sets with a
+        set intersection, and it stops once every peer has had them.
+    """
+    needed = peer.needed_pieces_list()
+    peer.random.shuffle(needed)
+    # Shuffle the ids rather than peers itself: same draws, same order.
+    order = [p.id for p in peers]
+    peer.random.shuffle(order)
+    rank = dict((pid, r) for (r, pid) in enumerate(order))
+
+    max_requests = peer.max_requests
+    if max_requests <= 0:
+        return []
+
+    swarm = peer.swarm
+    pieces = peer.pieces
+    partial = peer.partial
+    bpp = peer.conf.blocks_per_piece
+
+    # Appending in shuffled order keeps each bucket in the order a stable
+    # sort would leave it.
+    buckets = dict()  # (holder count, blocks missing) -> [piece ids]
+    for piece_id in needed:
+        count = swarm.holder_count(piece_id)
+        if count > 0:
+            # A needed piece that isn't partial has no blocks yet.
+            missing = bpp - pieces[piece_id] if piece_id in partial else bpp
+            buckets.setdefault((count, missing), []).append(piece_id)
+
+    requests = []
+    sent = dict((pid, 0) for pid in order)
+    open_ids = set(order)   # peers we can still send requests to
+    for key in sorted(buckets.keys()):
+        for piece_id in buckets[key]:
+            holders = swarm.holders(piece_id) & open_ids
+            if not holders:
+                continue
+            start = pieces[piece_id]
+            for holder_id in sorted(holders, key=rank.__getitem__):
+                requests.append(Request(peer.id, holder_id, piece_id, start))
+                sent[holder_id] += 1
+                if sent[holder_id] >= max_requests:
+                    open_ids.discard(holder_id)
+            if not open_ids:
+                return requests
+    return requests
@@ -4,15 +4,24 @@
 # Implemented by Rangel (Milushev) and Pancho (Francisco Trujillo)
 # For the 2018 edition of CS136 at Harvard University
 
-import random
 import logging
 import math
 
-from messages import Upload, Request
+try:
+    import numpy as np
+except ImportError:
+    # batch_uploads() falls back to uploads() without it.
+    np = None
+
+from messages import Upload
 from util import even_split
 from peer import Peer
+from pieceselect import rarest_first
 
 class RanchoPropShare(Peer):
+    # Only looks at the last round of history
+    history_lookback = 1
+
     def post_init(self):
         # {peer_id : flow_in_blocks}
         self.peer_download_rate = dict()
@@ -30,43 +39,9 @@ class RanchoPropShare(Peer):
         returns: List of Request objects.
         requests be called after update_pieces
         """
-        sent_requests = []
-
-        needed_pieces = self.needed_pieces_list()
-
-        random.shuffle(needed_pieces)
-
-        random.shuffle(peers)
-
-        # Finding which peers have the pieces we need
-        # [(piece_id, [holder_id_list])]
-        pieces_by_holder_id_list = []
-        for piece_id in needed_pieces:
-            holder_peer_id_list = []
-            for peer in peers:
-                if piece_id in peer.available_pieces:
-                    holder_peer_id_list.append(peer.id)
-            pieces_by_holder_id_list.append((piece_id, holder_peer_id_list))
-
-        # Sort pieces by rarity
-        # Tie breaking the sorting by prioritizing pieces that we're close to completing.
-        # This is important to that we can start sharing them as soon as possible.
-        pieces_by_rarity_list = sorted(pieces_by_holder_id_list, key=lambda (piece_id, holders): (len(holders), self.conf.blocks_per_piece - self.pieces[piece_id]))
-
-        # Keep track of sent requests to not reach the max
-        sent_requests_per_peer = {peer.id: 0 for peer in peers}
-
-        # Requesting the rarest piece first
-        for piece_id, holder_id_list in pieces_by_rarity_list:
-            for holder_id in holder_id_list:
-                # Don't make more requests than the maximum number of requests
-                if sent_requests_per_peer[holder_id] < self.max_requests:
-                    first_block = self.pieces[piece_id]
-                    request = Request(self.id, holder_id, piece_id, first_block)
-                    sent_requests.append(request)
-                    sent_requests_per_peer[holder_id] += 1
-
-        return sent_requests
+        # Rarest pieces first, ties going to the ones we're closest to
+        # completing, so that we can start sharing them as soon as possible.
+        return rarest_first(self, peers)
 
     def uploads(self, incoming_requests, peers, history):
         """
@@ -76,22 +51,128 @@ class RanchoPropShare(Peer):
         returns: list of Upload objects.
         uploads will be called after requests
         """
-        current_round = history.current_round()
-
-        # [(peer, bandwidth)]
-        bandwidth_by_peer = []
+        self.observe(history)
+        if len(incoming_requests) == 0:
+            return []
+
+        (givers, requester_id_list) = self.split_requesters(incoming_requests)
+        if len(self.giver_peer_id_set) > 0:
+            total_download_volume = self.total_download_volume()
+            bandwidth_by_peer = [
+                (pid, int(self.reciprocative_bandwidth * self.up_bw * blocks / total_download_volume))
+                for (pid, blocks) in givers]
+            return self.finish_uploads(bandwidth_by_peer)
+        return self.split_evenly(requester_id_list)
+
+    @classmethod
+    def batch_uploads(cls, agents, inputs):
+        """
+        uploads() for all the PropShare agents at once, worked out from
+        the UploadInputs columns in a few NumPy steps: who gave to whom
+        last round, each giver's proportional share, what is left over and
+        who gets it.  Only the shuffle of each agent's requesters is done
+        an agent at a time, since it draws on the agent's own random
+        stream.  Gives the same uploads as calling uploads() on each agent
+        (up to rounding in the totals when rates are fractional).
+
+        Unlike uploads(), this doesn't keep the observe() bookkeeping
+        (peer_download_rate and the giver and receiver sets) on the
+        agents.  optimistically_unchoked_peer is kept.
+        """
+        if np is None:
+            return [a.uploads(r, p, h) for (a, r, p, h) in zip(
+                agents, inputs.requests, inputs.peers, inputs.histories)]
+
+        ids = inputs.ids
+        n = len(agents)
+        request_agent = np.frombuffer(inputs.request_agent, dtype=np.int_)
+        request_from = np.frombuffer(inputs.request_from, dtype=np.int_)
+
+        # Each agent's requesters without duplicates, in the order they
+        # first asked in, then shuffled by the agent's own random stream,
+        # as split_requesters() does.  The sim files a requester's requests
+        # together, so each requester first asks at the start of its run.
+        # Only the shuffle is per agent.
+        keys = request_agent * len(ids) + request_from
+        starts = np.ones(len(keys), dtype=bool)
+        starts[1:] = keys[1:] != keys[:-1]
+        first = np.flatnonzero(starts)
+        rows = request_agent[first]      # one entry per (agent, requester)
+        bounds = np.searchsorted(rows, np.arange(n + 1)).tolist()
+        requesters = request_from[first].tolist()
+        for (i, a) in enumerate(agents):
+            (start, end) = (bounds[i], bounds[i + 1])
+            if end - start > 1:
+                shuffled = requesters[start:end]
+                a.random.shuffle(shuffled)
+                requesters[start:end] = shuffled
+        cols = np.array(requesters, dtype=np.int_)
+
+        # Last round's totals, sorted by (agent, giver) so each requester
+        # can be looked up in them
+        received_agent = np.frombuffer(inputs.received_agent, dtype=np.int_)
+        received_from = np.frombuffer(inputs.received_from, dtype=np.int_)
+        received_blocks = np.frombuffer(inputs.received_blocks)
+        has_givers = np.bincount(received_agent, minlength=n) > 0
+        total_download_volume = np.bincount(
+            received_agent, weights=received_blocks, minlength=n)
+        keys = received_agent * len(ids) + received_from
+        order = np.argsort(keys)
+        keys = keys[order]
+        wanted = rows * len(ids) + cols
+        at = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+        if len(keys) > 0:
+            gave = keys[at] == wanted
+        else:
+            gave = np.zeros(len(rows), dtype=bool)
+
+        # Each agent's last requester that didn't give it anything is
+        # unchoked.
+        not_givers = np.flatnonzero(~gave)
+        last = np.searchsorted(rows[not_givers], np.arange(n), side="right") - 1
+        for i in np.flatnonzero(last >= 0).tolist():
+            j = not_givers[last[i]]
+            if rows[j] == i:
+                agents[i].optimistically_unchoked_peer = ids[cols[j]]
+
+        # int(reciprocative_bandwidth * up_bw * blocks / total), as uploads()
+        scale = np.array([a.reciprocative_bandwidth * a.up_bw for a in agents])
+        giver_rows = rows[gave]
+        shares = (scale[giver_rows] * received_blocks[order[at[gave]]] /
+                  total_download_volume[giver_rows]).astype(np.int64)
+        up_bw = np.array([a.up_bw for a in agents], dtype=np.int64)
+        remaining = up_bw - np.bincount(giver_rows, weights=shares,
+                                        minlength=n).astype(np.int64)
+
+        giver_bounds = np.searchsorted(giver_rows, np.arange(n + 1)).tolist()
+        giver_ids = [ids[j] for j in cols[gave].tolist()]
+        shares = shares.tolist()
+        remaining = remaining.tolist()
+        has_givers = has_givers.tolist()
+        out = []
+        for (i, a) in enumerate(agents):
+            if bounds[i] == bounds[i + 1]:
+                out.append([])
+            elif has_givers[i]:
+                (start, end) = (giver_bounds[i], giver_bounds[i + 1])
+                out.append(a.make_uploads(
+                    zip(giver_ids[start:end], shares[start:end]) +
+                    [(a.optimistically_unchoked_peer, remaining[i])]))
+            else:
+                out.append(a.split_evenly(
+                    map(ids.__getitem__, requesters[bounds[i]:bounds[i + 1]])))
+        return out
 
+    def observe(self, history):
+        """Update what we know about who gave to and got from us last
+        round."""
+        current_round = history.current_round()
         if current_round > 0:
-            last_round_download_history = history.downloads[current_round - 1]
-            last_round_upload_history = history.uploads[current_round - 1]
-
-            self.receiver_peer_id_set = set(map(lambda upload: upload.to_id, last_round_upload_history))
-            self.giver_peer_id_set = set(map(lambda download: download.from_id, last_round_download_history))
+            # Total blocks downloaded from each peer last round {peer_id : blocks}
+            downloaded_from_peer = history.received_from(current_round - 1)
 
-            # Accumulating total downloads for each peer
-            downloaded_from_peer = {peer_id: 0 for peer_id in self.giver_peer_id_set}
-            for download in last_round_download_history:
-                downloaded_from_peer[download.from_id] += download.blocks
+            self.receiver_peer_id_set = set(history.uploaded_to(current_round - 1))
+            self.giver_peer_id_set = set(downloaded_from_peer)
 
             self.peer_download_rate = dict()
 
@@ -99,35 +180,50 @@ class RanchoPropShare(Peer):
             for peer_id, blocks in downloaded_from_peer.items():
                 self.peer_download_rate[peer_id] = blocks
 
-        if len(incoming_requests) > 0:
-            # We don't want duplicates
-            requester_id_list = list({r.requester_id for r in incoming_requests})
-
-            # Random order
-            random.shuffle(requester_id_list)
-
-            # Calculate the bandwidth percentage, based on what the others requested
-            for requester_id in requester_id_list:
-                if requester_id in self.giver_peer_id_set:
-                    bandwidth_by_peer.append((requester_id, self.peer_download_rate[requester_id]))
-                else:
-                    self.optimistically_unchoked_peer = requester_id
+    def split_requesters(self, incoming_requests):
+        """
+        Returns ([(giver id, blocks it gave us)], [requester ids]), the
+        requesters in a random order.  The last requester that didn't give
+        us anything becomes the optimistically unchoked peer.
+        """
+        # We don't want duplicates.  They're kept in the order they first
+        # asked in, not in set order, so that the shuffle only depends on
+        # self.random and not on how the ids hash.
+        requester_id_list = []
+        seen = set()
+        for r in incoming_requests:
+            if r.requester_id not in seen:
+                seen.add(r.requester_id)
+                requester_id_list.append(r.requester_id)
+
+        # Random order
+        self.random.shuffle(requester_id_list)
+
+        # Calculate the bandwidth percentage, based on what the others requested
+        givers = []
+        for requester_id in requester_id_list:
+            if requester_id in self.giver_peer_id_set:
+                givers.append((requester_id, self.peer_download_rate[requester_id]))
+            else:
+                self.optimistically_unchoked_peer = requester_id
+        return (givers, requester_id_list)
 
-            if len(self.giver_peer_id_set) > 0:
-                total_download_volume = sum(map(lambda (pid, download): download, self.peer_download_rate.items()))
+    def total_download_volume(self):
+        return sum(self.peer_download_rate.values())
 
-                bandwidth_by_peer = map(lambda (pid, blocks): (pid, int(self.reciprocative_bandwidth * self.up_bw * blocks / total_download_volume)), bandwidth_by_peer)
+    def finish_uploads(self, bandwidth_by_peer):
+        """Uploads for the givers' shares, plus the rest of our bandwidth to
+        the optimistically unchoked peer."""
+        remaining_bandwith = self.up_bw - sum(bw for (pid, bw) in bandwidth_by_peer)
 
-                remaining_bandwith = self.up_bw - sum(map(lambda (pid, bw): bw, bandwidth_by_peer))
-                print remaining_bandwith
+        bandwidth_by_peer = bandwidth_by_peer + [
+            (self.optimistically_unchoked_peer, remaining_bandwith)]
+        return self.make_uploads(bandwidth_by_peer)
 
-                bandwidth_by_peer.append((self.optimistically_unchoked_peer, remaining_bandwith))
-            else:
-                bandwidth_by_peer = zip(requester_id_list, even_split(self.up_bw, len(requester_id_list)))
+    def split_evenly(self, requester_id_list):
+        return self.make_uploads(
+            zip(requester_id_list, even_split(self.up_bw, len(requester_id_list))))
 
+    def make_uploads(self, bandwidth_by_peer):
         # create actual uploads out of the list of peer ids and bandwidths
-        uploads = [Upload(self.id, peer_id, bw) for (peer_id, bw) in bandwidth_by_peer]
-        return uploads
-
-    def needed_pieces_list(self):
-        return filter(lambda i: self.pieces[i] < self.conf.blocks_per_piece, range(len(self.pieces)))
+        return [Upload(self.id, peer_id, bw) for (peer_id, bw) in bandwidth_by_peer]
@@ -4,14 +4,17 @@
 # Implemented by Rangel (Milushev) and Pancho (Francisco Trujillo)
 # For the 2018 edition of CS136 at Harvard University
 
-import random
 import logging
 
-from messages import Upload, Request
+from messages import Upload
 from util import even_split
 from peer import Peer
+from pieceselect import rarest_first
 
 class RanchoStd(Peer):
+    # Looks at the last two rounds of downloads
+    history_lookback = 2
+
     def post_init(self):
         self.upload_slots = 4
         self.optimistic_slots = 1
@@ -24,43 +27,9 @@ class RanchoStd(Peer):
         returns: List of Request objects.
         requests be called after update_pieces
         """
-        sent_requests = []
-
-        needed_pieces = self.needed_pieces_list()
-
-        random.shuffle(needed_pieces)
-
-        random.shuffle(peers)
-
-        # Finding which peers have the pieces we need
-        # [(piece_id, [holder_id_list])]
-        pieces_by_holder_id_list = []
-        for piece_id in needed_pieces:
-            holder_peer_id_list = []
-            for peer in peers:
-                if piece_id in peer.available_pieces:
-                    holder_peer_id_list.append(peer.id)
-            pieces_by_holder_id_list.append((piece_id, holder_peer_id_list))
-
-        # Sort pieces by rarity
-        # Tie breaking the sorting by prioritizing pieces that we're close to completing.
-        # This is important to that we can start sharing them as soon as possible.
-        pieces_by_rarity_list = sorted(pieces_by_holder_id_list, key=lambda (piece_id, holders): (len(holders), self.conf.blocks_per_piece - self.pieces[piece_id]))
-
-        # Keep track of sent requests to not reach the max
-        sent_requests_per_peer = {peer.id: 0 for peer in peers}
-
-        # Requesting the rarest piece first
-        for piece_id, holder_id_list in pieces_by_rarity_list:
-            for holder_id in holder_id_list:
-                # Don't make more requests than the maximum number of requests
-                if sent_requests_per_peer[holder_id] < self.max_requests:
-                    first_block = self.pieces[piece_id]
-                    request = Request(self.id, holder_id, piece_id, first_block)
-                    sent_requests.append(request)
-                    sent_requests_per_peer[holder_id] += 1
-
-        return sent_requests
+        # Rarest pieces first, ties going to the ones we're closest to
+        # completing, so that we can start sharing them as soon as possible.
+        return rarest_first(self, peers)
 
     def uploads(self, incoming_requests, peers, history):
         """
@@ -78,13 +47,7 @@ class RanchoStd(Peer):
 
         if current_round > 1:
             # Since decisions are made every 10 secs, 20 seconds is best represented by two rounds.
-            cooperative_peers = {d.from_id: d.blocks for d in history.downloads[current_round - 1]}
-
-            for download in history.downloads[current_round - 2]:
-                if download.from_id in cooperative_peers:
-                    cooperative_peers[download.from_id] += download.blocks
-                else:
-                    cooperative_peers[download.from_id] = download.blocks
+            cooperative_peers = history.received_in_last(2)
 
         # Nobody wants our pieces
         if len(incoming_requests) == 0:
@@ -93,7 +56,7 @@ class RanchoStd(Peer):
             requester_id_list = list({r.requester_id for r in incoming_requests})
 
             # Requesters shuffled for impartiality
-            random.shuffle(requester_id_list)
+            self.random.shuffle(requester_id_list)
 
             cooperative_peer_id_list = map(lambda x: x[1], sorted(cooperative_peers.iteritems(), key=lambda (k,v): (v,k), reverse=True))
 
@@ -132,6 +95,3 @@ class RanchoStd(Peer):
         uploads = [Upload(self.id, peer_id, bw) for (peer_id, bw) in zip(unchoked_peer_id_list, bandwidths)]
 
         return uploads
-
-    def needed_pieces_list(self):
-        return filter(lambda i: self.pieces[i] < self.conf.blocks_per_piece, range(len(self.pieces)))
@@ -4,14 +4,17 @@
 # Implemented by Rangel (Milushev) and Pancho (Francisco Trujillo)
 # For the 2018 edition of CS136 at Harvard University
 
-import random
 import logging
 
-from messages import Upload, Request
-from util import even_split
+from messages import Upload
+from util import even_split, popcount
 from peer import Peer
+from pieceselect import rarest_first
 
 class RanchoTourney(Peer):
+    # Only looks at the last round of history
+    history_lookback = 1
+
     def post_init(self):
         self.assumed_peer_slots = 4
         # {peer_id : flow_in_blocks}
@@ -35,43 +38,9 @@ class RanchoTourney(Peer):
         returns: List of Request objects.
         requests be called after update_pieces
         """
-        sent_requests = []
-
-        needed_pieces = self.needed_pieces_list()
-
-        random.shuffle(needed_pieces)
-
-        random.shuffle(peers)
-
-        # Finding which peers have the pieces we need
-        # [(piece_id, [holder_id_list])]
-        pieces_by_holder_id_list = []
-        for piece_id in needed_pieces:
-            holder_peer_id_list = []
-            for peer in peers:
-                if piece_id in peer.available_pieces:
-                    holder_peer_id_list.append(peer.id)
-            pieces_by_holder_id_list.append((piece_id, holder_peer_id_list))
-
-        # Sort pieces by rarity
-        # Tie breaking the sorting by prioritizing pieces that we're close to completing.
-        # This is important to that we can start sharing them as soon as possible.
-        pieces_by_rarity_list = sorted(pieces_by_holder_id_list, key=lambda (piece_id, holders): (len(holders), self.conf.blocks_per_piece - self.pieces[piece_id]))
-
-        # Keep track of sent requests to not reach the max
-        sent_requests_per_peer = {peer.id: 0 for peer in peers}
-
-        # Requesting the rarest piece first
-        for piece_id, holder_id_list in pieces_by_rarity_list:
-            for holder_id in holder_id_list:
-                # Don't make more requests than the maximum number of requests
-                if sent_requests_per_peer[holder_id] < self.max_requests:
-                    first_block = self.pieces[piece_id]
-                    request = Request(self.id, holder_id, piece_id, first_block)
-                    sent_requests.append(request)
-                    sent_requests_per_peer[holder_id] += 1
-
-        return sent_requests
+        # Rarest pieces first, ties going to the ones we're closest to
+        # completing, so that we can start sharing them as soon as possible.
+        return rarest_first(self, peers)
 
     def uploads(self, incoming_requests, peers, history):
         """
@@ -89,11 +58,11 @@ class RanchoTourney(Peer):
             self.rounds_unchoked_by_peer = {peer.id: 0 for peer in peers}
             self.estimated_min_upload_rate_to_peer = {peer.id: self.initial_min_upload_rate for peer in peers}
         else:
-            last_round_download_history = history.downloads[current_round - 1]
-            last_round_upload_history = history.uploads[current_round - 1]
+            # Total blocks downloaded from each peer last round {peer_id : blocks}
+            downloaded_from_peer = history.received_from(current_round - 1)
 
-            self.receiver_peer_id_set = set(map(lambda upload: upload.to_id, last_round_upload_history))
-            self.giver_peer_id_set = set(map(lambda download: download.from_id, last_round_download_history))
+            self.receiver_peer_id_set = set(history.uploaded_to(current_round - 1))
+            self.giver_peer_id_set = set(downloaded_from_peer)
 
             # Adjusting upload rates
             for receiver_peer_id in self.receiver_peer_id_set:
@@ -109,23 +78,19 @@ class RanchoTourney(Peer):
                         # Decrease min upload speed
                         self.estimated_min_upload_rate_to_peer[receiver_peer_id] *= self.bandwith_decreasing_factor
 
-            # Accumulating total downloads for each peer
-            downloaded_from_peer = {peer_id: 0 for peer_id in self.giver_peer_id_set}
-            for download in last_round_download_history:
-                downloaded_from_peer[download.from_id] += download.blocks
-
             # Observed download flow
             for peer_id, blocks in downloaded_from_peer.items():
                 self.expected_peer_download_rate[peer_id] = blocks
 
             # Estimated download flow for a single peer
+            needed_mask = self.needed_mask()
             for peer in peers:
                 # These are the peers who didn't upload to us
                 if peer.id not in self.giver_peer_id_set:
                     peer_pieces_now = len(peer.available_pieces)
 
                     # If the peer has the same pieces, we shouldn't be interested in uploading to them
-                    interest_in_peer = len(set(self.needed_pieces_list()) & set(peer.available_pieces))
+                    interest_in_peer = popcount(needed_mask & peer.available_mask)
 
                     if interest_in_peer > 0:
                         # Estimating their rate based on the game structure
@@ -142,7 +107,7 @@ class RanchoTourney(Peer):
             requester_id_list = list({r.requester_id for r in incoming_requests})
 
             # Random order
-            random.shuffle(requester_id_list)
+            self.random.shuffle(requester_id_list)
 
             # Sorts from largest to smallest ratio
             sorted_requester_id_list = sorted(requester_id_list, key=lambda peer_id: self.peer_ratio(peer_id), reverse=True)
@@ -165,8 +130,3 @@ class RanchoTourney(Peer):
     def peer_ratio(self, peer_id):
         ratio = float(self.expected_peer_download_rate[peer_id]) / (self.estimated_min_upload_rate_to_peer[peer_id] + 1)
         return ratio, peer_id
-
-    def needed_pieces_list(self):
-        return filter(lambda i: self.pieces[i] < self.conf.blocks_per_piece, range(len(self.pieces)))
-
-
@@ -1,11 +1,13 @@
 #!/usr/bin/python
 
-import random
 from messages import Upload, Request
 from util import even_split
 from peer import Peer
 
 class Seed(Peer):
+    # Doesn't look at history
+    history_lookback = 0
+
     def requests(self, peers, history):
         # Seeds don't need anything.
         return []
@@ -19,6 +21,6 @@ class Seed(Peer):
             return []
         bws = even_split(self.up_bw, n)
         uploads = [Upload(self.id, p_id, bw)
-                   for (p_id, bw) in zip(random.sample(requester_ids, n), bws)]
+                   for (p_id, bw) in zip(self.random.sample(requester_ids, n), bws)]
         
         return uploads
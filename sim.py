@@ -12,21 +12,29 @@ import re
 import random
 import sys
 import logging
-import copy
+import time
 import itertools
 import pprint
+import multiprocessing
 from optparse import OptionParser
 
-from messages import Upload, Request, Download, PeerInfo
+from messages import Upload, Request, PeerInfo, DownloadBatch
 from util import *
-from stats import Stats
+from stats import Stats, Summary
 from history import History
+from swarm import ENGINES
+from timing import PhaseTimer, NullTimer, CallTimes
+from views import OthersView, SwarmView
+from agentpool import AgentPool
+from peer import batch_groups, UploadInputs
 
 
 class Sim:
     def __init__(self, config):
         self.config = config
         self.up_bws_state = dict()
+        # Reseeded at the start of each simulation
+        self.rng = random.Random()
 
 
     def up_bw(self, peer_id, reinit=False):
@@ -40,109 +48,100 @@ class Sim:
 
         """Sets the upload bandwidth of seeds to max, other agents at random"""
         if re.match("Seed",peer_id): the_up_bw = c.max_up_bw
-        else: the_up_bw = random.randint(c.min_up_bw, c.max_up_bw)
+        else: the_up_bw = self.rng.randint(c.min_up_bw, c.max_up_bw)
 
         return s.setdefault(peer_id, the_up_bw)
 
-    def run_sim_once(self):
-        """Return a history"""
+    def run_sim_once(self, seed):
+        """Return a history.  seed determines the sim's and every peer's
+        random stream."""
         conf = self.config
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0
 
-        def check_pred(pred, msg, Exc, lst):
-            """Check if any element of lst matches the predicate.  If it does,
-            raise an exception of type Exc, including the msg and the offending
-            element."""
-            m = map(pred, lst)
-            if True in m:
-                i = m.index(True)
-                raise Exc(msg + " Bad element: %s" % lst[i])
-
         def check_uploads(peer, uploads):
-            """Raise an IllegalUpload exception if there is a problem."""
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalUpload, uploads)
-
-            not_upload = lambda o: not isinstance(o, Upload)
-            check(not_upload, "List of Uploads contains non-Upload object.")
-
-            self_upload = lambda upload: upload.to_id == peer.id
-            check(self_upload, "Can't upload to yourself.")
-
-            not_from_self = lambda upload: upload.from_id != peer.id
-            check(not_from_self, "Upload.from != peer id.")
-
-            check(lambda u: u.bw < 0, "Upload bandwidth must be non-negative!")
+            """Raise an IllegalUpload exception if there is a problem.
+            Makes a single pass, running every check on each upload."""
+            def bad(msg, u):
+                raise IllegalUpload(msg + " Bad element: %s" % u)
+
+            total_bw = 0
+            for u in uploads:
+                if not isinstance(u, Upload):
+                    bad("List of Uploads contains non-Upload object.", u)
+                if u.to_id == peer.id:
+                    bad("Can't upload to yourself.", u)
+                if u.from_id != peer.id:
+                    bad("Upload.from != peer id.", u)
+                if u.bw < 0:
+                    bad("Upload bandwidth must be non-negative!", u)
+                total_bw += u.bw
 
             limit = self.up_bw(peer.id)
-            if sum(map(lambda u: u.bw, uploads)) > limit:
+            if total_bw > limit:
                 raise IllegalUpload("Can't upload more than limit of %d. %s" % (
                     limit, uploads))
 
             # If we got here, looks ok.
 
-        def check_requests(peer, requests, peer_pieces, available):
-            """Raise an IllegalRequest exception if there is a problem."""
-
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalRequest, requests)
-
-            check(lambda o: not isinstance(o, Request),
-                  "List of Requests contains non-Request object.")
-
-            bad_piece_id = lambda r: (r.piece_id < 0 or
-                                      r.piece_id >= self.config.num_pieces)
-            check(bad_piece_id, "Request asks for non-existent piece!")
-
-            bad_peer_id = lambda r: r.peer_id not in self.peer_ids
-            check(bad_peer_id, "Request mentions non-existent peer!")
-
-            bad_requester_id = lambda r: r.requester_id != peer.id
-            check(bad_requester_id, "Request has wrong peer id!")
-
-            bad_start_block = lambda r: (
-                r.start < 0 or
-                r.start >= self.config.blocks_per_piece or
-                r.start > peer_pieces[peer.id][r.piece_id])
-            # Must request the _next_ necessary block
-            check(bad_start_block, "Request has bad start block!")
-
-            def piece_peer_does_not_have(r):
-                other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
-            check(piece_peer_does_not_have, "Asking for piece peer does not have!")
+        def check_requests(peer, requests, state, inbox):
+            """Raise an IllegalRequest exception if there is a problem.
+            Makes a single pass, running every check on each request, and
+            files the ones that pass into inbox:
+            uploader peer_id -> [Requests to that peer]."""
+            def bad(msg, r):
+                raise IllegalRequest(msg + " Bad element: %s" % r)
+
+            # Python ints: comparing numpy scalars is slow.
+            my_pieces = state.row_ints(peer.id)
+            for r in requests:
+                if not isinstance(r, Request):
+                    bad("List of Requests contains non-Request object.", r)
+                if r.piece_id < 0 or r.piece_id >= conf.num_pieces:
+                    bad("Request asks for non-existent piece!", r)
+                if r.peer_id not in self.peers_by_id:
+                    bad("Request mentions non-existent peer!", r)
+                if r.requester_id != peer.id:
+                    bad("Request has wrong peer id!", r)
+                # Must request the _next_ necessary block
+                if (r.start < 0 or
+                    r.start >= conf.blocks_per_piece or
+                    r.start > my_pieces[r.piece_id]):
+                    bad("Request has bad start block!", r)
+                if r.piece_id not in state.available[r.peer_id]:
+                    bad("Asking for piece peer does not have!", r)
+                inbox[r.peer_id].append(r)
 
             # If we got here, looks ok
 
-        def available_pieces(peer_id, peer_pieces):
-            """
-            Return a list of piece ids that this peer has available.
-            """
-            return filter(lambda i: peer_pieces[peer_id][i] == conf.blocks_per_piece,
-                          range(conf.num_pieces))
-
-        def peer_done(peer_pieces, peer_id):
-            # TODO: remove linear pass
-            for blocks_so_far in peer_pieces[peer_id]:
-                if blocks_so_far < conf.blocks_per_piece:
-                    return False
-            return True
-
-        def all_done(peer_pieces):
-            result = True
-            # Check all peers to update done status
-            for peer_id in peer_pieces:
-                if peer_done(peer_pieces, peer_id):
-                    history.peer_is_done(round, peer_id)
-                else:
-                    result = False
-            return result
+        def file_requests(requests, inbox):
+            """Like check_requests, but trusts the requests."""
+            for r in requests:
+                inbox[r.peer_id].append(r)
+
+        def validated_peers():
+            """The ids of the peers whose output gets checked this round."""
+            if conf.validate == "full":
+                return self.peers_by_id
+            if conf.validate == "off":
+                return set()
+            # "sampled": check each peer with probability 1/validate_every.
+            # The draws come from their own stream, so turning sampling on
+            # or off doesn't change the rest of the run.
+            return set(pid for pid in self.peer_ids
+                       if validate_rng.random() * conf.validate_every < 1)
+
+        def all_done(state):
+            """Record the peers that finished since the last check, and
+            return True once no peer needs anything."""
+            for peer_id in state.pop_newly_done():
+                history.peer_is_done(round, peer_id)
+            return state.all_done()
 
         def create_peers():
             """Each agent class must be already loaded, and have a
-            constructor that takes the config, id,  pieces, and
-            up and down bandwidth, in that order."""
+            constructor that takes the config, id,  pieces,
+            up bandwidth and random stream, in that order."""
 
             def load(class_name, params):
                 agent_class = conf.agent_classes[class_name]
@@ -177,42 +176,158 @@ class Sim:
             # Re-initialize upload bandwidths at the beginning of each
             # new simulation
             up_bws = [self.up_bw(id, reinit=True) for id in ids]
-            params = zip(r(conf), ids, pieces, up_bws)
+            rngs = [random.Random(derive_seed(seed, id)) for id in ids]
+            params = zip(r(conf), ids, pieces, up_bws, rngs)
 
             peers = map(load, conf.agent_class_names, params)
             #logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
             return peers, peer_pieces
 
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return filter(lambda peer: peer.id != p.id, peer_info)
-
-            pieces = copy.copy(peer_pieces[p.id])
-            # Made copy of pieces and the peer info this peer needs to make it's
-            # decision, so that it can't change the simulation's copies.
-            p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
+        def others(p, peer_info):
+            """peer_info without p's own entry.  A view, not a new list."""
+            return OthersView(peer_info, position[p.id])
+
+        def within_budget(p, method, out, took):
+            """Record that p's call to method took `took` seconds, and return
+            its output, out.  With --time-budget, a call that ran over gets
+            [] instead.  The call can't be cut short, but the agent gains
+            nothing from the extra time."""
+            if calls is None:
+                return out
+            over = (conf.time_budget is not None and
+                    took * 1000 > conf.time_budget)
+            calls.add(p.__class__.__name__, method, took, over)
+            if over:
+                logging.warning("%s took %.1f ms in %s() in round %d, over the "
+                                "%.1f ms budget.  Ignoring its output.",
+                                p.id, took * 1000, method, round,
+                                conf.time_budget)
+                return []
+            return out
+
+        def call_agent(p, method, *args):
+            """Call p's requests() or uploads(), timing it when timing calls."""
+            f = getattr(p, method)
+            if calls is None:
+                return f(*args)
+            started = time.time()
+            out = f(*args)
+            return within_budget(p, method, out, time.time() - started)
+
+        def file_peer_requests(p, rs, state, inbox, validate):
+            """Check p's requests if validate, and file them in inbox."""
+            t = timer.start()
+            if validate:
+                check_requests(p, rs, state, inbox)
+            else:
+                file_requests(rs, inbox)
+            timer.stop("validation", t, p.__class__.__name__)
             return rs
 
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return filter(lambda peer: peer.id != p.id, peer_info)
-
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in all_requests.values():
-                    ans.extend(filter(f, rs))
-                return ans
+        def check_peer_uploads(p, us, validate):
+            if validate:
+                t = timer.start()
+                check_uploads(p, us)
+                timer.stop("validation", t, p.__class__.__name__)
+            return us
 
-            requests = requests_to(p.id)
+        def get_peer_requests(p, peer_info, peer_history, state, inbox, validate):
+            # The agent gets read-only views of its pieces and of the
+            # other peers' info, so that it can't change the simulation's
+            # copies.
+            class_name = p.__class__.__name__
+            t = timer.start()
+            p.update_pieces(state.pieces_view(p.id), state.pop_changed(p.id))
+            rs = call_agent(p, "requests", others(p, peer_info), peer_history)
+            timer.stop("requests", t, class_name)
+            return file_peer_requests(p, rs, state, inbox, validate)
+
+        def get_peer_uploads(requests, p, peer_info, peer_history, validate):
+            """requests: the Requests addressed to p this round."""
+            class_name = p.__class__.__name__
+            t = timer.start()
+            us = call_agent(p, "uploads", requests, others(p, peer_info),
+                            peer_history)
+            timer.stop("uploads", t, class_name)
+            return check_peer_uploads(p, us, validate)
+
+        def call_batch_hooks(method, peer_info, h, state, inbox):
+            """
+            Call batch_<method> once for each agent class that defines it.
+            Returns dict : peer_id -> output, for the agents of those
+            classes.  For --time-budget, each agent is charged the batch's
+            average time per agent.
+            """
+            out = dict()
+            for (agent_class, agents) in batches[method]:
+                views = [others(p, peer_info) for p in agents]
+                hs = [h[p.id] for p in agents]
+                t = timer.start()
+                started = time.time()
+                if method == "requests":
+                    for p in agents:
+                        p.update_pieces(state.pieces_view(p.id),
+                                        state.pop_changed(p.id))
+                    results = agent_class.batch_requests(agents, views, hs)
+                else:
+                    results = agent_class.batch_uploads(agents, UploadInputs(
+                        [inbox[p.id] for p in agents], views, hs, history))
+                took = (time.time() - started) / len(agents)
+                timer.stop(method, t, agent_class.__name__)
+                for (p, result) in zip(agents, results):
+                    out[p.id] = within_budget(p, method, result, took)
+            return out
+
+        def agent_phase(peer_info, state, inbox, checked):
+            """Get every peer's requests, then every peer's uploads, in this
+            process.  Returns (requests, uploads): dicts : peer_id -> list"""
+            requests = dict()
+            uploads = dict()
+            h = dict((p.id, history.peer_history(p.id)) for p in peers)
+            batched = call_batch_hooks("requests", peer_info, h, state, inbox)
+            for p in peers:
+                if p.id in batched:
+                    requests[p.id] = file_peer_requests(p, batched[p.id], state,
+                                                        inbox, p.id in checked)
+                else:
+                    requests[p.id] = get_peer_requests(p, peer_info, h[p.id],
+                                                       state, inbox,
+                                                       p.id in checked)
 
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
-            check_uploads(p, us)
-            return us
+            batched = call_batch_hooks("uploads", peer_info, h, state, inbox)
+            for p in peers:
+                if p.id in batched:
+                    uploads[p.id] = check_peer_uploads(p, batched[p.id],
+                                                       p.id in checked)
+                else:
+                    uploads[p.id] = get_peer_uploads(inbox[p.id], p, peer_info,
+                                                     h[p.id], p.id in checked)
+            return (requests, uploads)
+
+        def pooled_agent_phase(state, inbox, checked):
+            """Like agent_phase, but the agents run in agent_pool's worker
+            processes.  Their output is checked and filed here, as usual."""
+            requests = dict()
+            uploads = dict()
+            t = timer.start()
+            results = agent_pool.requests()
+            timer.stop("requests", t)
+            for p in peers:
+                (rs, took, cpu) = results[p.id]
+                timer.add(("requests", p.__class__.__name__), took, cpu)
+                rs = within_budget(p, "requests", rs, took)
+                requests[p.id] = file_peer_requests(p, rs, state, inbox,
+                                                    p.id in checked)
+
+            t = timer.start()
+            results = agent_pool.uploads(inbox)
+            timer.stop("uploads", t)
+            for p in peers:
+                (us, took, cpu) = results[p.id]
+                timer.add(("uploads", p.__class__.__name__), took, cpu)
+                us = within_budget(p, "uploads", us, took)
+                uploads[p.id] = check_peer_uploads(p, us, p.id in checked)
+            return (requests, uploads)
 
         def upload_rate(uploads, uploader_id, requester_id):
             """
@@ -224,18 +339,18 @@ class Sim:
                     return u.bw
             return 0
 
-        def update_peer_pieces(peer_pieces, requests, uploads, available):
+        def update_peer_pieces(state, requests, uploads):
             """
             Process the uploads: figure out how many blocks of all the requested
             pieces the requesters ended up with.
             Make sure requesting the same thing from lots of peers doesn't
             stack.
-            update the sets of available pieces as needed.
+            All of the round's downloads are worked out before any of them
+            are applied, so they all see the start-of-round state.  Then apply
+            just those changes to the piece state, which also updates the sets
+            of available pieces.  Returns the round's DownloadBatch.
             """
-            downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
-            for requester_id in requests:
-                downloads[requester_id] = list()
+            downloads = DownloadBatch()
             for requester_id in requests:
                 # Keep track of how many blocks of each piece this
                 # requester got.  piece -> (blocks, from_who)
@@ -265,134 +380,287 @@ class Sim:
                             break
                 for piece_id in new_blocks_per_piece:
                     (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
-                    d = Download(peer_id, requester_id, piece_id, blocks)
-                    downloads[requester_id].append(d)
-
-            return (new_pp, downloads)
-
-        def completed_pieces(peer_id, available):
-            return len(available[peer_id])
-
-        def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
-                            for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
-
-
-        logging.debug("Starting simulation with config: %s" % str(conf))
+                    downloads.add(peer_id, requester_id, piece_id, blocks)
+
+            state.apply(downloads)
+            return downloads
+
+        def history_window(peers):
+            """How many rounds of history to keep in memory, or None for all.
+            --history-window logs to disk, so older rounds can still be read.
+            --lookback drops them: N rounds (checked against what the agents
+            declare in parse_config), or with 'auto' as many as the agents
+            declare they need."""
+            lookback = conf.lookback
+            if lookback == "auto":
+                declared = [p.history_lookback for p in peers]
+                lookback = None if None in declared else max(declared)
+            windows = [w for w in (lookback, conf.history_window) if w is not None]
+            if len(windows) == 0:
+                return None
+            # Always keep the round that just finished, for logging.
+            return max(1, max(windows))
+
+        def completed_str(state):
+            return ", ".join("%s:%s" % (p_id, state.completed_pieces(p_id))
+                             for p_id in self.peer_ids)
+
+        def log_peer_info(state):
+            # Don't even loop over the peers unless the output will be shown.
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                for p_id in self.peer_ids:
+                    logging.debug("pieces for %s: %s",
+                                  p_id, state.peer_pieces(p_id))
+            logging.info("Pieces completed: %s", Lazy(completed_str, state))
+
+
+        logging.debug("Starting simulation with config: %s", conf)
+
+        # Wall and CPU time per phase, with --profile
+        timer = PhaseTimer() if conf.profile else NullTimer()
+        self.timer = timer
+        # Time of each agent call, with --profile or --time-budget
+        calls = None
+        if conf.profile or conf.time_budget is not None:
+            calls = CallTimes()
+        self.call_times = calls
+
+        self.rng = random.Random(derive_seed(seed, "Sim"))
+        validate_rng = random.Random(derive_seed(seed, "validate"))
 
         peers, peer_pieces = create_peers()
         self.peer_ids = [p.id for p in peers]
+        self.peer_classes = [(p.id, p.__class__.__name__) for p in peers]
         self.peers_by_id = dict((p.id, p) for p in peers)
+        # peer_id -> index in peers (and in each round's peer_info)
+        position = dict((p.id, i) for (i, p) in enumerate(peers))
+        # method -> [(agent class, [agents])] for classes with batch hooks
+        batches = dict((m, batch_groups(peers, m))
+                       for m in ("requests", "uploads"))
 
         upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
-
-        # dict : pid -> set(finished / available pieces)
-        available = dict((pid, set(available_pieces(pid, peer_pieces)))
-                         for pid in self.peer_ids)
+        history = History(self.peer_ids, upload_rates, history_window(peers),
+                          conf.history_window is not None, conf.history_dir)
+
+        # Blocks per piece, available pieces and completion counts for
+        # every peer, updated in place as downloads happen.
+        state = ENGINES[conf.engine](conf.blocks_per_piece, peer_pieces)
+        # The engine owns the piece table now; don't keep a second copy.
+        peer_pieces = None
+        swarm = SwarmView(state)
+        for p in peers:
+            p.swarm = swarm
+
+        # With --agent-workers, the agents' decisions are made in worker
+        # processes that own the agents from here on.
+        agent_pool = None
+        if conf.agent_workers > 1:
+            agent_pool = AgentPool(conf.agent_workers, peers,
+                                   dict((pid, state.peer_pieces(pid))
+                                        for pid in self.peer_ids),
+                                   upload_rates, conf, history_window(peers),
+                                   seed)
 
         # Begin the event loop
-        while True:
-            logging.info("======= Round %d ========" % round)
-
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
-            uploads = dict()   # peer_id -> list of Uploads
-            h = dict()
-            for p in peers:
-                h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
-
-            for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
-
-
-            (peer_pieces, downloads) = update_peer_pieces(
-                peer_pieces, requests, uploads, available)
-            history.update(downloads, uploads)
-
-            logging.debug(history.pretty_for_round(round))
-
-            log_peer_info(peer_pieces, available)
-
-            if all_done(peer_pieces):
-                logging.info("All done!")
-                break
-            round += 1
-            if round > conf.max_round:
-                logging.info("Out of time.  Stopping.")
-                break
-
-        logging.info("Game history:\n%s" % history.pretty())
+        try:
+            while True:
+                logging.info("======= Round %d ========", round)
+
+                peer_info = [PeerInfo(p.id, state.available_snapshot(p.id),
+                                      state.available_mask(p.id))
+                             for p in peers]
+                # peer_id -> list of Requests _to_ that peer, filled in by
+                # check_requests as each requester is validated.
+                inbox = dict((pid, []) for pid in self.peer_ids)
+                checked = validated_peers()
+                # requests, uploads: peer_id -> list of Requests / Uploads
+                if agent_pool is None:
+                    (requests, uploads) = agent_phase(peer_info, state, inbox,
+                                                      checked)
+                else:
+                    (requests, uploads) = pooled_agent_phase(state, inbox, checked)
+
+                t = timer.start()
+                downloads = update_peer_pieces(state, requests, uploads)
+                timer.stop("update_peer_pieces", t)
+                t = timer.start()
+                history.update(downloads, uploads)
+                if agent_pool is not None:
+                    agent_pool.update(downloads, uploads)
+                timer.stop("history", t)
+
+                t = timer.start()
+                logging.debug("%s", Lazy(history.pretty_for_round, round))
+
+                log_peer_info(state)
+                timer.stop("logging", t)
+
+                if all_done(state):
+                    logging.info("All done!")
+                    break
+                round += 1
+                if round > conf.max_round:
+                    logging.info("Out of time.  Stopping.")
+                    break
+        finally:
+            if agent_pool is not None:
+                agent_pool.close()
+
+        # Log the history one round at a time instead of building one
+        # huge string, and skip it entirely if it won't be shown.
+        t = timer.start()
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Game history:\nHistory")
+            if history.first_round() > 0:
+                logging.info("(Rounds before %d were not kept)",
+                             history.first_round())
+            for r in range(history.first_round(), history.last_round() + 1):
+                logging.info("%s", Lazy(history.pretty_for_round, r))
 
         logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
+        logging.info("Uploaded blocks:\n%s",
+                     Lazy(Stats.uploaded_blocks_str, self.peer_ids, history))
+        logging.info("Completion rounds:\n%s",
+                     Lazy(Stats.completion_rounds_str, self.peer_ids, history))
+        logging.info("All done round: %s",
+                     Lazy(Stats.all_done_round, self.peer_ids, history))
+        logging.info("Swarm throughput (blocks / round): %s",
+                     Lazy(Stats.swarm_throughput_str, history))
+        timer.stop("logging", t)
 
         return history
 
-    def run_sim(self):
-        histories = map(lambda i: self.run_sim_once(),
-                        range(self.config.iters))
-        logging.warning("======== SUMMARY STATS ========")
-
-        uploaded_blocks = map(
-            lambda h: Stats.uploaded_blocks(self.peer_ids, h),
-            histories)
-        completion_rounds = map(
-            lambda h: Stats.completion_rounds(self.peer_ids, h),
-            histories)
-
-        def extract_by_peer_id(lst, peer_id):
-            """Given a list of dicts, pull out the entry
-            for peer_id from each dict.  Return a list"""
-            return map(lambda d: d[peer_id], lst)
-
-        uploaded_by_id = dict(
-            (p_id, extract_by_peer_id(uploaded_blocks, p_id))
-            for p_id in self.peer_ids)
-
-        completion_by_id = dict(
-            (p_id, extract_by_peer_id(completion_rounds, p_id))
-            for p_id in self.peer_ids)
-
-        logging.warning("Uploaded blocks: avg (stddev)")
-        for p_id in sorted(self.peer_ids,
-                           key=lambda id: mean(uploaded_by_id[id])):
-            us = uploaded_by_id[p_id]
-            logging.warning("%s: %.1f  (%.1f)" % (p_id, mean(us), stddev(us)))
-
-        logging.warning("Completion rounds: avg (stddev)")
-
-        def optionize(f):
-            def g(lst):
-                if None in lst:
-                    return None
-                else:
-                    return f(lst)
-            return g
+    def run_iteration(self, seed):
+        """Run one simulation from seed.  Returns just what the
+        summary stats need: (peer_classes, uploaded_blocks, completion_rounds,
+        timer, call_times), where timer is None unless profiling and
+        call_times is None unless profiling or enforcing a time budget."""
+        # For agents that still use the random module directly.
+        random.seed(seed)
+        history = self.run_sim_once(seed)
+        try:
+            return (self.peer_classes,
+                    Stats.uploaded_blocks(self.peer_ids, history),
+                    Stats.completion_rounds(self.peer_ids, history),
+                    self.timer if self.config.profile else None,
+                    self.call_times)
+        finally:
+            history.close()
+
+    def run_iterations(self, seeds):
+        """Run an iteration per seed, folding each into a Summary as soon as
+        it finishes.  Returns the Summary."""
+        summary = Summary()
+        for seed in seeds:
+            summary.add_iteration(*self.run_iteration(seed))
+        return summary
+
+    def iteration_seeds(self, start=0, stop=None):
+        """Seeds for iterations start..stop-1 (by default, all --iters of
+        them).  Each iteration's seed depends only on the master seed and
+        its index, so it is the same whichever process ends up running it."""
+        if stop is None:
+            stop = self.config.iters
+        return [derive_seed(self.config.seed, i) for i in range(start, stop)]
+
+    def run_batch(self, pool, seeds):
+        """Run an iteration per seed, in pool if it's not None.  Returns a
+        Summary."""
+        if pool is None:
+            return self.run_iterations(seeds)
+        # Each worker folds its share of the iterations into its own
+        # Summary; only those come back to be merged.
+        workers = self.config.workers
+        summary = Summary()
+        chunks = [(self.config, seeds[i::workers])
+                  for i in range(min(workers, len(seeds)))]
+        for s in pool.imap(run_iterations, chunks):
+            summary.merge(s)
+        return summary
+
+    def run_until_precise(self, pool):
+        """
+        Keep running iterations until every per-class mean is known to
+        within --tolerance, or --max-iters have run.  Runs --iters (at
+        least 2) first, then a batch of one per worker at a time.
+        Returns the Summary.
+        """
+        conf = self.config
+        summary = Summary()
+        done = 0
+        batch = max(conf.iters, 2)
+        while done < conf.max_iters:
+            stop = min(done + batch, conf.max_iters)
+            summary.merge(self.run_batch(pool, self.iteration_seeds(done, stop)))
+            done = stop
+            if summary.precise_enough(conf.tolerance):
+                break
+            batch = max(conf.workers, 1)
+        return summary
 
-        opt_mean = optionize(mean)
-        opt_stddev = optionize(stddev)
+    def run_all(self, pool):
+        """Run --iters iterations, or with --tolerance until precise enough.
+        pool: as for run_batch.  Returns the Summary."""
+        if self.config.tolerance is None:
+            return self.run_batch(pool, self.iteration_seeds())
+        return self.run_until_precise(pool)
 
-        for p_id in sorted(self.peer_ids,
-                           key=lambda id: opt_mean(completion_by_id[id])):
-            cs = completion_by_id[p_id]
-            logging.warning("%s: %s  (%s)" % (p_id, opt_mean(cs), opt_stddev(cs)))
+    def run_sim(self):
+        """Run all the iterations and log summary stats.  Returns the
+        Summary."""
+        pool = None
+        if self.config.workers > 1:
+            pool = multiprocessing.Pool(self.config.workers)
+        try:
+            summary = self.run_all(pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.peer_ids = summary.peer_ids
 
+        logging.warning("======== SUMMARY STATS ========")
+        logging.warning("Seed: %d" % self.config.seed)
+
+        def log_stats(title, names, by_name, fmt):
+            """by_name: dict : name -> RunningStats"""
+            logging.warning(title)
+            for name in sorted(names, key=lambda n: by_name[n].mean()):
+                s = by_name[name]
+                logging.warning(("%s: " + fmt) % (name, s.mean(), s.stddev()))
+
+        log_stats("Uploaded blocks: avg (stddev)",
+                  summary.peer_ids, summary.uploaded, "%.1f  (%.1f)")
+        log_stats("Uploaded blocks by agent class: avg (stddev)",
+                  summary.class_names(), summary.class_uploaded, "%.1f  (%.1f)")
+        log_stats("Completion rounds: avg (stddev)",
+                  summary.peer_ids, summary.completion, "%s  (%s)")
+        log_stats("Completion rounds by agent class: avg (stddev)",
+                  summary.class_names(), summary.class_completion, "%s  (%s)")
+
+        if self.config.tolerance is not None:
+            logging.warning("Precision after %d iterations (%s, tolerance "
+                            "%.1f%%):\n%s", summary.iters,
+                            "reached" if summary.precise_enough(
+                                self.config.tolerance) else "NOT reached",
+                            self.config.tolerance * 100,
+                            summary.pretty_precision())
+
+        if self.config.profile:
+            logging.warning("Seconds per iteration: avg (stddev)\n%s",
+                            summary.times.pretty(summary.class_names()))
+        if self.config.profile or self.config.time_budget is not None:
+            logging.warning("Agent call times (ms):\n%s",
+                            summary.calls.pretty(summary.class_names()))
+
+        return summary
+
+
+def run_iterations(args):
+    """Pool worker entry point: args is (config, seeds).  Returns a
+    Summary of those iterations."""
+    (config, seeds) = args
+    return Sim(config).run_iterations(seeds)
 
 
 def configure_logging(loglevel):
@@ -429,7 +697,8 @@ def parse_agents(args):
 
 
 
-def main(args):
+def parse_config(args):
+    """args: a command line, as in sys.argv.  Returns (options, config)."""
     usage_msg = "Usage:  %prog [options] PeerClass1[,count] PeerClass2[,count] ..."
     parser = OptionParser(usage=usage_msg)
 
@@ -462,12 +731,86 @@ def main(args):
                       dest="max_up_bw", default=10, type="int",
                       help="Max upload bandwidth")
 
+    parser.add_option("--engine",
+                      dest="engine", default="lists", type="choice",
+                      choices=sorted(ENGINES.keys()),
+                      help="How to store swarm piece state: 'lists', or 'numpy' to save memory in big swarms")
+
     parser.add_option("--iters",
                       dest="iters", default=1, type="int",
                       help="Number of times to run simulation to get stats")
 
 
-    (options, args) = parser.parse_args()
+    parser.add_option("--tolerance",
+                      dest="tolerance", default=None, type="float",
+                      help="Run iterations until the 95% confidence "
+                      "interval of each agent class's mean uploaded blocks "
+                      "and completion round is within this fraction of the "
+                      "mean (e.g. 0.05).  --iters is then the minimum")
+
+    parser.add_option("--max-iters",
+                      dest="max_iters", default=1000, type="int",
+                      help="With --tolerance, stop after this many "
+                      "iterations even if not precise enough")
+
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of processes to run iterations in")
+
+    parser.add_option("--agent-workers",
+                      dest="agent_workers", default=1, type="int",
+                      help="Number of processes to run the agents' decisions "
+                      "in, within each round.  Can't be combined with --workers")
+
+    parser.add_option("--validate",
+                      dest="validate", default="full", type="choice",
+                      choices=["full", "sampled", "off"],
+                      help="How much to check agents' requests and uploads: "
+                      "'full', 'sampled' (a random subset of agents each round), "
+                      "or 'off' for trusted agents")
+
+    parser.add_option("--validate-every",
+                      dest="validate_every", default=10, type="int",
+                      help="With --validate sampled, check each agent in about "
+                      "one round out of this many")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=None, type="int",
+                      help="Keep only this many recent rounds of history in "
+                      "memory, and log every round to disk")
+
+    parser.add_option("--history-dir",
+                      dest="history_dir", default=None,
+                      help="With --history-window, keep the on-disk history "
+                      "logs in this directory (default: temporary, deleted "
+                      "after each simulation)")
+
+    parser.add_option("--lookback",
+                      dest="lookback", default=None,
+                      help="Only keep this many recent rounds of history, and "
+                      "drop older ones.  Must be at least as many as every "
+                      "agent says it looks at.  'auto' keeps just that many")
+
+    parser.add_option("--profile",
+                      dest="profile", default=False, action="store_true",
+                      help="Report wall and CPU time spent in each phase of "
+                      "the sim, and per agent class")
+
+    parser.add_option("--time-budget",
+                      dest="time_budget", default=None, type="float",
+                      help="Milliseconds each requests() or uploads() call "
+                      "may take.  Output of a call that takes longer is "
+                      "ignored for that round")
+
+    parser.add_option("--cprofile",
+                      dest="cprofile", default=None,
+                      help="Run under cProfile and save the stats to this file")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Master random seed.  Picked at random if not given")
+
+    (options, args) = parser.parse_args(args[1:])
 
     # leftover args are class names, with optional counts:
     # "Peer Seed[,4]"
@@ -481,7 +824,6 @@ def main(args):
         except ValueError, e:
             usage(e)
 
-    configure_logging(options.loglevel)
     config = Params()
 
     config.add("agent_class_names", agents_to_run)
@@ -494,13 +836,49 @@ def main(args):
     config.add("min_up_bw", options.min_up_bw)
     config.add("max_up_bw", options.max_up_bw)
     config.add("iters", options.iters)
+    config.add("tolerance", options.tolerance)
+    config.add("max_iters", options.max_iters)
+    config.add("engine", options.engine)
+    config.add("workers", options.workers)
+    if options.workers > 1 and options.agent_workers > 1:
+        usage("--workers and --agent-workers can't both be more than 1")
+    config.add("agent_workers", options.agent_workers)
+    config.add("validate", options.validate)
+    config.add("validate_every", options.validate_every)
+    config.add("history_window", options.history_window)
+    config.add("history_dir", options.history_dir)
+    if options.lookback not in (None, "auto"):
+        try:
+            options.lookback = int(options.lookback)
+        except ValueError:
+            usage("--lookback must be a number or 'auto'")
+        # Agents read back as far as they declare, so keeping fewer rounds
+        # would fail partway through the run.
+        for name in sorted(set(config.agent_class_names)):
+            needs = config.agent_classes[name].history_lookback
+            if needs is None or needs > options.lookback:
+                usage("--lookback %d is too short for %s, which looks back "
+                      "%s rounds" % (options.lookback, name,
+                                     "all" if needs is None else needs))
+    config.add("lookback", options.lookback)
+    if options.seed is None:
+        options.seed = random.randint(0, sys.maxint)
+    config.add("seed", options.seed)
+    config.add("profile", options.profile)
+    config.add("time_budget", options.time_budget)
+    return (options, config)
+
+
+def main(args, sim_class=Sim):
+    (options, config) = parse_config(args)
+    configure_logging(options.loglevel)
 
-    sim = Sim(config)
-    sim.run_sim()
+    sim = sim_class(config)
+    if options.cprofile is not None:
+        import cProfile
+        cProfile.runctx('sim.run_sim()', globals(), locals(), options.cprofile)
+    else:
+        sim.run_sim()
 
 if __name__ == "__main__":
-
-    # The next two lines are for profiling...
-    import cProfile
-    cProfile.run('main(sys.argv)', 'out.prof')
-#    main(sys.argv)
+    main(sys.argv)
@@ -1,6 +1,15 @@
 #!/usr/bin/python
 
+from util import RunningStats
+from timing import PhaseTimes, CallTimes
+
+
 class Stats:
+    """
+    Stats about one simulation.  All of them read the running aggregates
+    that History keeps, so each is O(peers) (or O(rounds) for throughput)
+    and works even when old rounds of history have been dropped.
+    """
     @staticmethod
     def uploaded_blocks(peer_ids, history):
         """
@@ -10,13 +19,7 @@ class Stats:
         Returns:
         dict: peer_id -> total upload blocks used
         """
-        uploaded = dict((peer_id, 0) for peer_id in peer_ids)
-        for peer_id in peer_ids:
-            for ds in history.downloads[peer_id]:
-                for download in ds:
-                    uploaded[download.from_id] += download.blocks
-                
-        return uploaded
+        return dict((peer_id, history.uploaded[peer_id]) for peer_id in peer_ids)
 
     @staticmethod
     def uploaded_blocks_str(peer_ids, history):
@@ -47,10 +50,173 @@ class Stats:
         return "\n".join("%s: %s" % (id, d[id])
                          for id in sorted(d.keys(), key=d.__getitem__))
 
+    @staticmethod
+    def swarm_throughput(history):
+        """Returns list: blocks downloaded by the whole swarm in each round"""
+        return history.throughput[:]
+
+    @staticmethod
+    def swarm_throughput_str(history):
+        """ Return a pretty stringified version of swarm_throughput """
+        t = Stats.swarm_throughput(history)
+        if len(t) == 0:
+            return "no rounds"
+        return "%s  (avg %.1f)" % (", ".join(map(str, t)),
+                                   sum(t) / float(len(t)))
+
     @staticmethod
     def all_done_round(peer_ids, history):
         d = Stats.completion_rounds(peer_ids, history)
         if None in d.values():
             return None
         return max(d.values())
-    
+
+
+class Summary:
+    """
+    Summary stats over many iterations, per peer and per agent class.
+    Iterations are folded in as they finish, so memory doesn't grow with
+    the number of iterations, and summaries built in different worker
+    processes can be merged.
+
+    peer_ids: [peer ids, in the order the sim created them]
+    peer_classes: dict : peer_id -> agent class name
+    uploaded, completion: dict : peer_id -> RunningStats
+    class_uploaded, class_completion: dict : class name -> RunningStats,
+        with one value per peer of that class per iteration.
+    iter_uploaded, iter_completion: dict : class name -> RunningStats, with
+        one value per iteration: the mean over that class's peers.  Peers in
+        one iteration aren't independent, so the confidence intervals use
+        these.
+    times: PhaseTimes, filled in when profiling.
+    calls: CallTimes, filled in when profiling or enforcing a time budget.
+    """
+    def __init__(self):
+        self.iters = 0
+        self.peer_ids = []
+        self.peer_classes = dict()
+        self.uploaded = dict()
+        self.completion = dict()
+        self.class_uploaded = dict()
+        self.class_completion = dict()
+        self.iter_uploaded = dict()
+        self.iter_completion = dict()
+        self.times = PhaseTimes()
+        self.calls = CallTimes()
+
+    def add_peer(self, peer_id, class_name):
+        if peer_id in self.peer_classes:
+            return
+        self.peer_ids.append(peer_id)
+        self.peer_classes[peer_id] = class_name
+        self.uploaded[peer_id] = RunningStats()
+        self.completion[peer_id] = RunningStats()
+        if class_name not in self.class_uploaded:
+            self.class_uploaded[class_name] = RunningStats()
+            self.class_completion[class_name] = RunningStats()
+            self.iter_uploaded[class_name] = RunningStats()
+            self.iter_completion[class_name] = RunningStats()
+
+    def add_iteration(self, peer_classes, uploaded, completion, timer=None,
+                      calls=None):
+        """
+        peer_classes: [(peer_id, class name)] in creation order
+        uploaded: dict : peer_id -> total upload blocks used
+        completion: dict : peer_id -> round completed, or None
+        timer: the iteration's PhaseTimer, if profiling
+        calls: the iteration's CallTimes, if timing calls
+        """
+        self.iters += 1
+        if timer is not None:
+            self.times.add_iteration(timer)
+        if calls is not None:
+            self.calls.merge(calls)
+        # class name -> (RunningStats, RunningStats) for this iteration
+        this_iter = dict()
+        for (pid, class_name) in peer_classes:
+            self.add_peer(pid, class_name)
+            self.uploaded[pid].add(uploaded[pid])
+            self.completion[pid].add(completion[pid])
+            self.class_uploaded[class_name].add(uploaded[pid])
+            self.class_completion[class_name].add(completion[pid])
+            if class_name not in this_iter:
+                this_iter[class_name] = (RunningStats(), RunningStats())
+            this_iter[class_name][0].add(uploaded[pid])
+            this_iter[class_name][1].add(completion[pid])
+        for (class_name, (u, c)) in this_iter.items():
+            self.iter_uploaded[class_name].add(u.mean())
+            self.iter_completion[class_name].add(c.mean())
+
+    def merge(self, other):
+        """Fold in the iterations other has seen."""
+        self.iters += other.iters
+        self.times.merge(other.times)
+        self.calls.merge(other.calls)
+        for pid in other.peer_ids:
+            self.add_peer(pid, other.peer_classes[pid])
+            self.uploaded[pid].merge(other.uploaded[pid])
+            self.completion[pid].merge(other.completion[pid])
+        for class_name in other.class_uploaded:
+            self.class_uploaded[class_name].merge(
+                other.class_uploaded[class_name])
+            self.class_completion[class_name].merge(
+                other.class_completion[class_name])
+            self.iter_uploaded[class_name].merge(
+                other.iter_uploaded[class_name])
+            self.iter_completion[class_name].merge(
+                other.iter_completion[class_name])
+
+    def class_names(self):
+        """Agent class names, in the order their peers were created."""
+        names = []
+        for pid in self.peer_ids:
+            if self.peer_classes[pid] not in names:
+                names.append(self.peer_classes[pid])
+        return names
+
+    def precision(self):
+        """
+        dict : (class name, metric) -> (95% confidence interval half-width,
+        half-width as a fraction of the mean), for metric "uploaded" and
+        "completion".  The interval is over the per-iteration class means,
+        so n is the number of iterations.  Both are None when they can't be
+        known yet: fewer than two iterations, or a peer that didn't finish.
+        """
+        p = dict()
+        for name in self.class_names():
+            for (metric, stats) in [("uploaded", self.iter_uploaded[name]),
+                                    ("completion", self.iter_completion[name])]:
+                hw = stats.half_width()
+                if hw is None:
+                    rel = None
+                elif hw == 0:
+                    rel = 0.0
+                elif stats.mean() == 0:
+                    rel = float("inf")
+                else:
+                    rel = hw / abs(stats.mean())
+                p[(name, metric)] = (hw, rel)
+        return p
+
+    def precise_enough(self, tolerance):
+        """True once every per-class mean is within tolerance (a fraction
+        of the mean).  Completion rounds can't be estimated while some peer
+        never finishes, so until then this is False."""
+        if self.iters < 2:
+            return False
+        for (hw, rel) in self.precision().values():
+            if rel is None or rel > tolerance:
+                return False
+        return True
+
+    def pretty_precision(self):
+        p = self.precision()
+        def fmt(hw, rel):
+            if hw is None and self.iters >= 2:
+                return "n/a (a peer didn't finish)"
+            if hw is None:
+                return "n/a"
+            return "+/-%.2f (%.1f%%)" % (hw, rel * 100)
+        return "\n".join("%s: uploaded %s, completion %s" % (
+            name, fmt(*p[(name, "uploaded")]), fmt(*p[(name, "completion")]))
+                         for name in self.class_names())
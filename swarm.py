@@ -0,0 +1,310 @@
+#!/usr/bin/python
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for the "numpy" engine.
+    np = None
+
+from util import to_mask
+from views import PiecesView, ArrayPiecesView
+
+
+class SwarmState:
+    """
+    Piece state of every peer in one simulation.
+
+    pieces: dict : peer_id -> [blocks downloaded so far, one entry per piece]
+    available: dict : peer_id -> set(piece ids the peer has finished)
+    available_masks: dict : peer_id -> the same set, as a bitmask
+    changed: dict : peer_id -> set(piece ids whose blocks changed since the
+        last pop_changed() for that peer)
+    holders: [set(peer ids that have the piece available)], one per piece.
+        The rarity index; kept in step with available.
+
+    The tables are updated in place, one round's downloads at a time.  The
+    sim computes all of a round's downloads against the start-of-round state
+    and only then hands them to apply(), so every download in a round still
+    sees the same starting point.
+
+    Agents get a read-only PiecesView of their own row, made once, and
+    read-only frozenset snapshots of the sets.  A snapshot is only rebuilt
+    after that set changes, so unchanged peers cost nothing per round.
+    """
+    def __init__(self, blocks_per_piece, pieces):
+        """
+        pieces: dict : peer_id -> [blocks / piece].  Owned by the state from
+        now on.
+        """
+        self.blocks_per_piece = blocks_per_piece
+        self.pieces = pieces
+
+        self.available = dict()
+        self.pieces_remaining = dict()  # peer_id -> pieces still needed
+        for pid, blocks in pieces.items():
+            self.available[pid] = set(i for i in range(len(blocks))
+                                      if blocks[i] == blocks_per_piece)
+            self.pieces_remaining[pid] = len(
+                filter(lambda b: b < blocks_per_piece, blocks))
+        self.init_holders()
+        self.init_masks()
+        self.changed = dict((pid, set()) for pid in pieces)
+
+        # Peers that still need something.  len() is the peers-remaining count.
+        self.unfinished = set(pid for pid in pieces
+                              if self.pieces_remaining[pid] > 0)
+        # Peers that finished since the last pop_newly_done().  Peers that
+        # start out with everything (seeds) are reported on the first call.
+        self.newly_done = [pid for pid in pieces if pid not in self.unfinished]
+
+        self.views = dict((pid, PiecesView(pieces[pid])) for pid in pieces)
+        self.available_snapshots = dict()  # peer_id -> frozenset(available)
+        self.holder_snapshots = dict()     # piece_id -> frozenset(holders)
+
+    def init_holders(self):
+        num_pieces = max([len(blocks) for blocks in self.pieces.values()] or [0])
+        self.holders = [set() for i in range(num_pieces)]
+        for pid in self.available:
+            for piece_id in self.available[pid]:
+                self.holders[piece_id].add(pid)
+
+    def init_masks(self):
+        self.available_masks = dict((pid, to_mask(self.available[pid]))
+                                    for pid in self.available)
+
+    def add_available(self, peer_id, piece_id):
+        """peer_id just finished piece_id."""
+        self.available[peer_id].add(piece_id)
+        self.available_masks[peer_id] |= 1 << piece_id
+        self.available_snapshots.pop(peer_id, None)
+        self.holders[piece_id].add(peer_id)
+        self.holder_snapshots.pop(piece_id, None)
+
+    def apply(self, downloads):
+        """
+        downloads: the round's DownloadBatch.
+
+        Add the downloaded blocks to the table, touching only the entries
+        that changed, and update availability and completion counts.
+        """
+        for (to_id, piece, blocks) in zip(downloads.to_id, downloads.piece,
+                                          downloads.blocks):
+            self.add_blocks(to_id, piece, blocks)
+
+    def add_blocks(self, peer_id, piece, blocks):
+        bpp = self.blocks_per_piece
+        row = self.pieces[peer_id]
+        old_blocks = row[piece]
+        row[piece] = old_blocks + blocks
+        self.changed[peer_id].add(piece)
+        if row[piece] == bpp:
+            self.add_available(peer_id, piece)
+        if old_blocks < bpp <= old_blocks + blocks:
+            self.pieces_remaining[peer_id] -= 1
+            if self.pieces_remaining[peer_id] == 0:
+                self.unfinished.discard(peer_id)
+                self.newly_done.append(peer_id)
+
+    def pop_changed(self, peer_id):
+        """The pieces of peer_id that changed since the last call."""
+        changed = self.changed[peer_id]
+        self.changed[peer_id] = set()
+        return changed
+
+    def pop_newly_done(self):
+        """Return the peers that finished since the last call."""
+        done = self.newly_done
+        self.newly_done = []
+        return done
+
+    def all_done(self):
+        return len(self.unfinished) == 0
+
+    def completed_pieces(self, peer_id):
+        return len(self.available[peer_id])
+
+    def peer_pieces(self, peer_id):
+        """A fresh list of blocks / piece for peer_id, safe to hand to an agent."""
+        return self.pieces[peer_id][:]
+
+    def row_ints(self, peer_id):
+        """blocks / piece for peer_id as Python ints, for the sim's own
+        reads.  May be the table's own list: don't change it or hand it to
+        an agent."""
+        return self.pieces[peer_id]
+
+    def pieces_view(self, peer_id):
+        """Read-only PiecesView of blocks / piece for peer_id.  Stays
+        current as downloads are applied."""
+        return self.views[peer_id]
+
+    def available_snapshot(self, peer_id):
+        """Read-only frozenset of the pieces peer_id has available."""
+        snapshot = self.available_snapshots.get(peer_id)
+        if snapshot is None:
+            snapshot = frozenset(self.available[peer_id])
+            self.available_snapshots[peer_id] = snapshot
+        return snapshot
+
+    def available_mask(self, peer_id):
+        """Bitmask of the pieces peer_id has available."""
+        return self.available_masks[peer_id]
+
+    def holder_count(self, piece_id):
+        return len(self.holders[piece_id])
+
+    def holders_snapshot(self, piece_id):
+        """Read-only frozenset of the peers that have piece_id available."""
+        snapshot = self.holder_snapshots.get(piece_id)
+        if snapshot is None:
+            snapshot = frozenset(self.holders[piece_id])
+            self.holder_snapshots[piece_id] = snapshot
+        return snapshot
+
+
+class NumpySwarmState(SwarmState):
+    """
+    SwarmState backed by NumPy matrices, for big swarms.
+
+    blocks: peers x pieces matrix of blocks downloaded so far, of the
+        smallest unsigned int type that holds blocks_per_piece (one byte
+        per cell up to 255 blocks per piece)
+
+    pieces[peer_id] is that peer's row of blocks.  available is still kept as
+    dict : peer_id -> set, since that is what agents see in PeerInfo, but it
+    is only touched for pieces that finish.  Applying a round's downloads and
+    spotting finished pieces and peers are vectorized.  The sets (changed,
+    available, holders) are then updated with one set.update() per peer or
+    piece touched, not one add() per download.  holder_counts is the number
+    of full cells in each column, kept up to date alongside it.
+
+    The matrix takes a fraction of the memory of lists of Python ints (8
+    bytes a cell on 64-bit), as long as the caller doesn't keep the lists
+    it was built from.  apply() is
+    faster than the lists engine when peers get many downloads per round;
+    when each peer only gets a few, the per-peer set updates dominate and
+    the two are about even.
+    """
+    def __init__(self, blocks_per_piece, pieces):
+        if np is None:
+            raise ImportError("The numpy engine needs numpy installed.")
+        self.blocks_per_piece = blocks_per_piece
+        self.peer_ids = list(pieces.keys())
+        self.row = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+        # row -> peer id, for picking out the ids of many rows at once
+        self.id_array = np.empty(len(self.peer_ids), dtype=object)
+        self.id_array[:] = self.peer_ids
+
+        self.blocks = np.array([pieces[pid] for pid in self.peer_ids],
+                               dtype=np.min_scalar_type(blocks_per_piece))
+        have = self.blocks == blocks_per_piece
+        self.pieces = dict((pid, self.blocks[i])
+                           for (i, pid) in enumerate(self.peer_ids))
+        self.available = dict((pid, set(np.flatnonzero(have[i]).tolist()))
+                              for (i, pid) in enumerate(self.peer_ids))
+        # pieces still needed, one entry per row
+        self.remaining = (self.blocks < blocks_per_piece).sum(axis=1)
+
+        self.unfinished = set(pid for (i, pid) in enumerate(self.peer_ids)
+                              if self.remaining[i] > 0)
+        self.newly_done = [pid for pid in self.peer_ids
+                           if pid not in self.unfinished]
+
+        self.views = dict((pid, ArrayPiecesView(self.pieces[pid]))
+                          for pid in self.peer_ids)
+        self.available_snapshots = dict()
+        self.holder_snapshots = dict()
+        self.init_holders()
+        self.init_masks()
+        self.changed = dict((pid, set()) for pid in self.peer_ids)
+        self.holder_counts = have.sum(axis=0)
+
+    def apply(self, downloads):
+        """
+        downloads: the round's DownloadBatch.
+
+        A requester gets at most one Download per piece in a round, so the
+        (row, piece) pairs are distinct and can be updated with one fancy
+        index.  The piece column is read as a buffer.
+        """
+        n = len(downloads)
+        if n == 0:
+            return
+        # A peer's downloads are together in the batch, so the rows come in
+        # runs of the same row.
+        rows = np.fromiter(map(self.row.__getitem__, downloads.to_id),
+                           np.intp, n)
+        cols = np.frombuffer(downloads.piece, dtype=np.int_).astype(np.intp)
+        amounts = np.fromiter(downloads.blocks, np.int64, n)
+
+        bpp = self.blocks_per_piece
+        before = self.blocks[rows, cols].astype(np.int64)
+        after = before + amounts
+        self.blocks[rows, cols] = after
+        # The per-peer and per-piece sets are updated a group at a time,
+        # not a download at a time.
+        for (i, piece_ids) in group_runs(rows, cols):
+            self.changed[self.peer_ids[i]].update(piece_ids)
+
+        now_available = after == bpp
+        new_rows = rows[now_available]
+        new_cols = cols[now_available]
+        self.holder_counts += np.bincount(new_cols,
+                                          minlength=len(self.holder_counts))
+        for (i, piece_ids) in group_runs(new_rows, new_cols):
+            pid = self.peer_ids[i]
+            self.available[pid].update(piece_ids)
+            self.available_masks[pid] |= to_mask(piece_ids)
+            self.available_snapshots.pop(pid, None)
+        for (piece_id, holder_ids) in group_by(new_cols,
+                                               self.id_array[new_rows]):
+            self.holders[piece_id].update(holder_ids)
+            self.holder_snapshots.pop(piece_id, None)
+
+        finished_rows = rows[(before < bpp) & (after >= bpp)]
+        if len(finished_rows) == 0:
+            return
+        np.subtract.at(self.remaining, finished_rows, 1)
+        for i in np.unique(finished_rows).tolist():
+            if self.remaining[i] == 0:
+                pid = self.peer_ids[i]
+                self.unfinished.discard(pid)
+                self.newly_done.append(pid)
+
+    def peer_pieces(self, peer_id):
+        return self.blocks[self.row[peer_id]].tolist()
+
+    def row_ints(self, peer_id):
+        return self.peer_pieces(peer_id)
+
+    def holder_count(self, piece_id):
+        return int(self.holder_counts[piece_id])
+
+
+def group_by(keys, values):
+    """
+    [(key, [values with that key])] for each distinct key, in increasing key
+    order.  keys: int array; values: array lined up with it.  Each group
+    keeps the order its values came in.
+    """
+    order = np.argsort(keys, kind="mergesort")
+    return group_runs(keys[order], values[order])
+
+
+def group_runs(keys, values):
+    """Like group_by(), for keys that already come in runs of equal keys:
+    [(key, [values])] for each run, in order."""
+    if len(keys) == 0:
+        return []
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    bounds = starts.tolist() + [len(keys)]
+    values = values.tolist()
+    return [(k, values[bounds[j]:bounds[j + 1]])
+            for (j, k) in enumerate(keys[starts].tolist())]
+
+
+# --engine name -> SwarmState class
+ENGINES = {
+    "lists": SwarmState,
+    "numpy": NumpySwarmState,
+}
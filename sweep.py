@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+"""
+Runs the simulation in sim.py over a grid of configurations.
+
+The grid is a JSON file:
+
+  {
+    "grid":  {"num-pieces": [8, 16],
+              "max-bw": [10, 16],
+              "agents": ["Seed,2 RanchoStd,4", "Seed,2 RanchoTyrant,4"]},
+    "fixed": {"iters": 5, "max-round": 200},
+    "seeds": [1, 2, 3]
+  }
+
+Keys are sim.py option names without the leading "--" ("agents" is the
+list of agent classes).  Every combination of the "grid" values is run with
+the "fixed" ones, once per master seed in "seeds".  The (config, seed)
+points run in a pool of --workers processes.  Each point runs as sim.py
+would: --iters iterations, or with "tolerance" until precise enough.  The
+options in NOT_IN_SPEC can't be set in a spec.
+
+Each point's Summary is cached in --cache-dir, keyed by a hash of the
+config, the simulator and agent source and the seed, so re-running a
+sweep (or a bigger one that overlaps it) only runs the new points.
+Changing any of the code makes the points run again.
+"""
+
+import os
+import sys
+import json
+import errno
+import hashlib
+import inspect
+import logging
+import itertools
+import cPickle as pickle
+import multiprocessing
+from optparse import OptionParser
+
+import sim
+
+
+# Config keys that don't change a point's results.  (profile does: a point
+# cached without it has no timings.)
+NOT_IN_KEY = set(["agent_classes", "workers", "seed", "history_dir"])
+
+# sim.py options a grid spec can't set, and what to use instead.
+NOT_IN_SPEC = {
+    "workers": "sweep.py --workers",
+    "seed": 'the spec\'s "seeds" list',
+    "loglevel": "sweep.py --loglevel",
+    "cprofile": "python -m cProfile sweep.py",
+}
+
+
+def point_args(settings, seed):
+    """A sim.py command line for one point.  settings: dict : option name
+    (without "--") -> value."""
+    args = ["sim.py", "--seed", str(seed)]
+    for name in sorted(settings.keys()):
+        value = settings[name]
+        if name == "agents":
+            continue
+        if value is True:
+            args.append("--" + name)
+        elif value is not False and value is not None:
+            args.extend(["--" + name, str(value)])
+    agents = settings.get("agents", "")
+    if isinstance(agents, list):
+        agents = " ".join(agents)
+    # json gives unicode, and peer ids (which seed the peers' random
+    # streams) must come out the same as from the command line.
+    return args + str(agents).split()
+
+
+def grid_points(spec):
+    """Yield (settings, seed) for every point of the grid spec."""
+    grid = spec.get("grid", {})
+    names = sorted(grid.keys())
+    for values in itertools.product(*[grid[n] for n in names]):
+        settings = dict(spec.get("fixed", {}))
+        settings.update(zip(names, values))
+        for seed in spec.get("seeds", [0]):
+            yield (settings, seed)
+
+
+def source_files(config):
+    """Every .py file next to sim.py (the engines, the history, the helpers
+    the agents import, ...), plus the files of the agent classes in config
+    and the classes they build on, wherever those live."""
+    here = os.path.dirname(os.path.abspath(sim.__file__))
+    files = set(os.path.join(here, f) for f in os.listdir(here)
+                if f.endswith(".py"))
+    for agent_class in config.agent_classes.values():
+        for c in inspect.getmro(agent_class):
+            f = inspect.getsourcefile(c)
+            if f is not None:
+                files.add(os.path.abspath(f))
+    return sorted(files)
+
+
+def package_source(config):
+    """The source the results of config depend on, so that changing any of
+    it changes the cache key."""
+    return "".join(open(f).read() for f in source_files(config))
+
+
+def cache_key(config):
+    h = hashlib.sha1()
+    h.update(repr(sorted((k, v) for (k, v) in config.__dict__.items()
+                         if k not in config._init_keys and
+                         k not in NOT_IN_KEY)))
+    h.update(package_source(config))
+    h.update(repr(config.seed))
+    return h.hexdigest()
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + ".pickle")
+
+
+def load_cached(cache_dir, key):
+    """The cached Summary for key, or None."""
+    try:
+        f = open(cache_path(cache_dir, key), "rb")
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        return pickle.load(f)
+    finally:
+        f.close()
+
+
+def save_cached(cache_dir, key, summary):
+    # Write then rename, so an interrupted sweep never leaves half a file.
+    path = cache_path(cache_dir, key)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    f = open(tmp, "wb")
+    try:
+        pickle.dump(summary, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+
+def run_point(args):
+    """Pool worker entry point: args is (key, config, cache_dir).  Runs
+    every iteration of the point, caches the Summary and returns
+    (key, Summary)."""
+    (key, config, cache_dir) = args
+    # Runs --iters iterations, or with --tolerance until precise enough,
+    # as sim.py does.
+    summary = sim.Sim(config).run_all(None)
+    save_cached(cache_dir, key, summary)
+    return (key, summary)
+
+
+def pretty_settings(settings):
+    return " ".join("%s=%s" % (k, settings[k]) for k in sorted(settings.keys()))
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options] GRID.json"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Set the logging level: 'debug' or 'info'")
+
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of processes to run points in")
+
+    parser.add_option("--cache-dir",
+                      dest="cache_dir", default=".sweep-cache",
+                      help="Directory to cache each point's results in")
+
+    (options, args) = parser.parse_args(args[1:])
+    if len(args) != 1:
+        parser.error("Give exactly one grid spec file")
+
+    sim.configure_logging(options.loglevel)
+    spec = json.load(open(args[0]))
+    for part in ("grid", "fixed"):
+        for name in spec.get(part, {}):
+            if name in NOT_IN_SPEC:
+                parser.error("%s can't be set in the grid spec; use %s" % (
+                    name, NOT_IN_SPEC[name]))
+    if not os.path.isdir(options.cache_dir):
+        os.makedirs(options.cache_dir)
+
+    points = []    # (settings, seed, key)
+    results = dict()  # key -> Summary
+    todo = []
+    for (settings, seed) in grid_points(spec):
+        (_, config) = sim.parse_config(point_args(settings, seed))
+        config.workers = 1   # the sweep does its own parallelism
+        if options.workers > 1 and config.agent_workers > 1:
+            # Points run in pool workers, which can't start processes.
+            parser.error("agent-workers can't be more than 1 with --workers "
+                         "more than 1")
+        key = cache_key(config)
+        points.append((settings, seed, key))
+        if key in results:
+            continue
+        summary = load_cached(options.cache_dir, key)
+        if summary is None:
+            results[key] = None
+            todo.append((key, config, options.cache_dir))
+        else:
+            results[key] = summary
+    logging.warning("%d points, %d cached, %d to run",
+                    len(points), len(results) - len(todo), len(todo))
+
+    if options.workers > 1:
+        pool = multiprocessing.Pool(options.workers)
+        try:
+            for (key, summary) in pool.imap_unordered(run_point, todo):
+                results[key] = summary
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for (key, summary) in itertools.imap(run_point, todo):
+            results[key] = summary
+
+    # One line per point and agent class: uploaded blocks and completion
+    # round, avg (stddev) over the point's iterations.
+    print "\t".join(["settings", "seed", "class", "uploaded", "completion"])
+    for (settings, seed, key) in points:
+        summary = results[key]
+        for name in summary.class_names():
+            u = summary.class_uploaded[name]
+            c = summary.class_completion[name]
+            print "\t".join([pretty_settings(settings), str(seed), name,
+                             "%.1f (%.1f)" % (u.mean(), u.stddev()),
+                             "%s (%s)" % (c.mean(), c.stddev())])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+import math
+import time
+
+from util import RunningStats
+
+
+# The phases of a round, in the order they happen.  The agent phases are
+# also broken down by agent class.
+PHASES = ["requests", "validation", "uploads", "update_peer_pieces",
+          "history", "logging"]
+AGENT_PHASES = ["requests", "validation", "uploads"]
+
+
+class PhaseTimer:
+    """
+    Wall and CPU time spent in each phase of one simulation, for --profile.
+
+        t = timer.start()
+        ...
+        timer.stop("requests", t, "RanchoStd")
+
+    wall, cpu: dict : phase -> seconds, and (phase, class name) -> seconds
+    for the agent phases.
+
+    With --agent-workers the agents run elsewhere.  The phase total is then
+    the time the sim waited for the workers, and the per-class times are
+    the workers' own, added up across workers with add().
+    """
+    def __init__(self):
+        self.wall = dict()
+        self.cpu = dict()
+
+    def start(self):
+        return (time.time(), time.clock())
+
+    def stop(self, phase, started, class_name=None):
+        (wall, cpu) = started
+        wall = time.time() - wall
+        cpu = time.clock() - cpu
+        self.add(phase, wall, cpu)
+        if class_name is not None:
+            self.add((phase, class_name), wall, cpu)
+
+    def add(self, key, wall, cpu):
+        """Count wall and cpu seconds, timed elsewhere, under key."""
+        self.wall[key] = self.wall.get(key, 0.0) + wall
+        self.cpu[key] = self.cpu.get(key, 0.0) + cpu
+
+
+class NullTimer:
+    """Stands in for PhaseTimer when not profiling, and does nothing."""
+    def start(self):
+        return None
+
+    def stop(self, phase, started, class_name=None):
+        pass
+
+    def add(self, key, wall, cpu):
+        pass
+
+
+class PhaseTimes:
+    """
+    Per-phase times summarized across iterations: one value per iteration
+    goes into a RunningStats for each phase (and phase, class name), so
+    this stays small however many iterations run, and merges like Summary.
+    """
+    def __init__(self):
+        self.wall = dict()   # key -> RunningStats of seconds / iteration
+        self.cpu = dict()
+
+    def add_iteration(self, timer):
+        for (times, stats) in [(timer.wall, self.wall), (timer.cpu, self.cpu)]:
+            for k in times:
+                stats.setdefault(k, RunningStats()).add(times[k])
+
+    def merge(self, other):
+        for (theirs, stats) in [(other.wall, self.wall), (other.cpu, self.cpu)]:
+            for k in theirs:
+                stats.setdefault(k, RunningStats()).merge(theirs[k])
+
+    def pretty(self, class_names):
+        """
+        Lines of per-iteration averages (stddev), slowest class first
+        within each agent phase.
+        """
+        def line(label, k):
+            w = self.wall[k]
+            c = self.cpu[k]
+            return "%-28s wall %.4f (%.4f)  cpu %.4f (%.4f)" % (
+                label, w.mean(), w.stddev(), c.mean(), c.stddev())
+
+        lines = []
+        for phase in PHASES:
+            if phase not in self.wall:
+                continue
+            lines.append(line(phase + ":", phase))
+            if phase in AGENT_PHASES:
+                keys = [(phase, n) for n in class_names
+                        if (phase, n) in self.wall]
+                keys.sort(key=lambda k: -self.wall[k].mean())
+                for k in keys:
+                    lines.append(line("  " + k[1] + ":", k))
+        return "\n".join(lines)
+
+
+class Histogram:
+    """
+    Counts of non-negative values in log-spaced buckets, BUCKETS_PER_DECADE
+    to each factor of ten, so percentiles come out to within about 12%
+    while memory stays bounded however many values go in.  Mergeable.
+    """
+    BUCKETS_PER_DECADE = 20
+    SMALLEST = 1e-7   # anything below this goes in the lowest bucket
+
+    def __init__(self):
+        self.counts = dict()   # bucket -> count
+        self.n = 0
+        self.max = 0.0
+
+    def bucket(self, x):
+        x = max(x, self.SMALLEST)
+        return int(math.floor(math.log10(x) * self.BUCKETS_PER_DECADE))
+
+    def add(self, x):
+        b = self.bucket(x)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.n += 1
+        self.max = max(self.max, x)
+
+    def merge(self, other):
+        for (b, count) in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + count
+        self.n += other.n
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Upper edge of the bucket holding the q-th percentile (0-100),
+        but never more than the largest value seen.  None if empty."""
+        if self.n == 0:
+            return None
+        rank = q / 100.0 * self.n
+        seen = 0
+        for b in sorted(self.counts.keys()):
+            seen += self.counts[b]
+            if seen >= rank:
+                break
+        return min(10 ** ((b + 1.0) / self.BUCKETS_PER_DECADE), self.max)
+
+
+class CallTimes:
+    """
+    How long each agent class's requests() and uploads() calls took, and
+    how many of them went over the --time-budget.
+
+    times: dict : (class name, method) -> Histogram of seconds per call
+    overruns: dict : (class name, method) -> calls over budget
+    """
+    METHODS = ["requests", "uploads"]
+
+    def __init__(self):
+        self.times = dict()
+        self.overruns = dict()
+
+    def add(self, class_name, method, seconds, overrun=False):
+        k = (class_name, method)
+        self.times.setdefault(k, Histogram()).add(seconds)
+        if overrun:
+            self.overruns[k] = self.overruns.get(k, 0) + 1
+
+    def merge(self, other):
+        for (k, h) in other.times.items():
+            self.times.setdefault(k, Histogram()).merge(h)
+        for (k, count) in other.overruns.items():
+            self.overruns[k] = self.overruns.get(k, 0) + count
+
+    def pretty(self, class_names):
+        """One line per class and method: call time percentiles in ms and
+        the number of budget overruns."""
+        ms = lambda s: s * 1000.0
+        lines = ["%-28s %8s %8s %8s %8s  %s" % (
+            "", "p50", "p90", "p99", "max", "overruns")]
+        for class_name in class_names:
+            for method in self.METHODS:
+                k = (class_name, method)
+                if k not in self.times:
+                    continue
+                h = self.times[k]
+                lines.append("%-28s %8.3f %8.3f %8.3f %8.3f  %d" % (
+                    "%s.%s:" % k, ms(h.percentile(50)), ms(h.percentile(90)),
+                    ms(h.percentile(99)), ms(h.max),
+                    self.overruns.get(k, 0)))
+        return "\n".join(lines)
@@ -5,6 +5,7 @@
 # http://stackoverflow.com/questions/5098580/implementing-argmax-in-python
 
 from itertools import imap, izip, count
+import hashlib
 import math
 
 
@@ -44,6 +45,71 @@ def stddev(lst):
     return math.sqrt(sum((x-m)*(x-m) for x in lst) / len(lst))
 
 
+class RunningStats:
+    """
+    Mean and standard deviation of a stream of numbers, updated one value at
+    a time (Welford's method), so only a few totals are kept however many
+    values go in.  Two RunningStats can be merged, e.g. ones built in
+    different processes.
+
+    None values (a peer that never finished, say) are counted, and make
+    mean() and stddev() return None.
+    """
+    def __init__(self):
+        self.n = 0          # values seen, not counting None
+        self.missing = 0    # Nones seen
+        self.total = 0
+        self.m = 0.0        # running mean
+        self.m2 = 0.0       # sum of squared differences from the mean
+
+    def add(self, x):
+        if x is None:
+            self.missing += 1
+            return
+        self.n += 1
+        self.total += x
+        delta = x - self.m
+        self.m += delta / float(self.n)
+        self.m2 += delta * (x - self.m)
+
+    def merge(self, other):
+        """Fold in the values other has seen."""
+        self.missing += other.missing
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.m - self.m
+        self.m += delta * other.n / float(n)
+        self.m2 += other.m2 + delta * delta * self.n * other.n / float(n)
+        self.n = n
+        self.total += other.total
+
+    def mean(self):
+        """Throws a div by zero exception if nothing has been added"""
+        if self.missing > 0:
+            return None
+        # The exact total keeps this the same as mean() of the values.
+        return self.total / float(self.n)
+
+    def stddev(self):
+        """Population standard deviation, like stddev()"""
+        if self.missing > 0:
+            return None
+        if self.n == 0:
+            return 0
+        return math.sqrt(max(self.m2, 0.0) / self.n)
+
+    def half_width(self, z=1.96):
+        """
+        Half-width of the confidence interval for the mean, by the normal
+        approximation (z=1.96 for 95%), using the sample standard
+        deviation.  None if there are Nones or fewer than two values.
+        """
+        if self.missing > 0 or self.n < 2:
+            return None
+        return z * math.sqrt(max(self.m2, 0.0) / (self.n - 1) / self.n)
+
+
 def median(numeric):
     vals = sorted(numeric)
     count = len(vals)
@@ -86,6 +152,58 @@ def even_split(n, k):
     return ans
 
 
+def to_mask(indices):
+    """
+    Bitmask with bit i set for each i in indices.  Used for sets of piece
+    ids, so that intersections and counts are word-level operations.
+
+    >>> to_mask([0, 2])
+    5
+    """
+    mask = 0
+    for i in indices:
+        mask |= 1 << i
+    return mask
+
+
+def mask_bits(mask):
+    """
+    The indices of the set bits of mask, in increasing order.
+
+    >>> list(mask_bits(5))
+    [0, 2]
+    """
+    i = 0
+    while mask:
+        if mask & 1:
+            yield i
+        mask >>= 1
+        i += 1
+
+
+def popcount(mask):
+    """
+    Number of set bits in mask: the size of the set it stands for.
+
+    >>> popcount(5)
+    2
+    """
+    return bin(mask).count("1")
+
+
+def derive_seed(*parts):
+    """
+    Derive an integer seed from a master seed and labels such as an
+    iteration number or a peer id.  Unlike hash(), the result is the same
+    in every run and every process.
+
+    >>> derive_seed(1, "Seed0") == derive_seed(1, "Seed0")
+    True
+    """
+    digest = hashlib.sha1(repr(parts)).hexdigest()
+    return int(digest[:15], 16)
+
+
 def load_modules(agent_classes):
     """Each agent class must be in module class_name.lower().
     Returns a dictionary class_name->class"""
@@ -100,6 +218,21 @@ def load_modules(agent_classes):
     
 
 
+class Lazy:
+    """
+    Defers building a string until it's needed.  Pass one as a logging
+    argument so the work is only done if the record is actually emitted:
+
+        logging.debug("%s", Lazy(history.pretty_for_round, round))
+    """
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+
+    def __str__(self):
+        return str(self.f(*self.args))
+
+
 class Params:
     def __init__(self):
         self._init_keys = set(self.__dict__.keys())
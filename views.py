@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+import itertools
+
+
+class OthersView(object):
+    """
+    The round's list of PeerInfo objects as one peer sees it: every entry
+    but its own.
+
+    Reads (len, indexing, iteration) go straight to the shared list, so no
+    per-peer list is built just to hide one entry.  An agent can still treat
+    it as its own list: the first call that would change it (shuffle, sort,
+    append, ...) first makes a private copy, and the shared list is never
+    touched.
+    """
+    def __init__(self, items, skip):
+        """
+        items: the shared list.  Must not change while the view is in use.
+        skip: index in items of the entry to hide.
+        """
+        self._items = items
+        self._skip = skip
+        self._own = None   # private copy, made on the first change
+
+    def _list(self):
+        if self._own is None:
+            self._own = list(self)
+        return self._own
+
+    def __len__(self):
+        if self._own is not None:
+            return len(self._own)
+        return len(self._items) - 1
+
+    def __iter__(self):
+        if self._own is not None:
+            return iter(self._own)
+        items = self._items
+        return itertools.chain(itertools.islice(items, 0, self._skip),
+                               itertools.islice(items, self._skip + 1, None))
+
+    def __getitem__(self, i):
+        if self._own is not None:
+            return self._own[i]
+        if isinstance(i, slice):
+            return list(self)[i]
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("list index out of range")
+        if i >= self._skip:
+            i += 1
+        return self._items[i]
+
+    def __setitem__(self, i, value):
+        self._list()[i] = value
+
+    def __delitem__(self, i):
+        del self._list()[i]
+
+    def __contains__(self, x):
+        return x in iter(self)
+
+    def __getattr__(self, name):
+        # Any other list method (sort, append, pop, index, ...) runs on the
+        # private copy.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._list(), name)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class PiecesView(object):
+    """
+    Read-only view of one peer's row of the piece table (blocks downloaded
+    per piece), handed to the agent as self.pieces.
+
+    It reads the sim's row directly: it's made once per peer, and is
+    always current, so nothing is copied when the row changes.  It has no
+    way to change the row.  Take list(view) to keep a copy of the row as it
+    is now.
+    """
+    __slots__ = ("_row",)
+
+    def __init__(self, row):
+        self._row = row
+
+    def __len__(self):
+        return len(self._row)
+
+    def __getitem__(self, i):
+        # A slice of a list is a new list, so it's safe to hand out.
+        return self._row[i]
+
+    def __iter__(self):
+        return iter(self._row)
+
+    def __contains__(self, x):
+        return x in self._row
+
+    def index(self, x):
+        return list(self).index(x)
+
+    def count(self, x):
+        return list(self).count(x)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class ArrayPiecesView(PiecesView):
+    """PiecesView of a NumPy row.  Gives Python ints, not numpy scalars,
+    which are slow to compare and would leak into the agents' Requests."""
+    __slots__ = ()
+
+    def __getitem__(self, i):
+        try:
+            return self._row.item(i)
+        except TypeError:
+            # a slice
+            return self._row[i].tolist()
+
+    def __iter__(self):
+        return iter(self._row.tolist())
+
+    def __contains__(self, x):
+        return x in self._row.tolist()
+
+
+class SwarmView(object):
+    """
+    Read-only view of the sim's rarity index: which peers have each piece
+    available.  The sim keeps the index current as pieces complete, so
+    agents don't need to rebuild it from PeerInfo every round.  Agents see
+    it as self.swarm.
+    """
+    def __init__(self, state):
+        self._state = state
+
+    def holder_count(self, piece_id):
+        """Number of peers that have piece_id available."""
+        return self._state.holder_count(piece_id)
+
+    def holders(self, piece_id):
+        """frozenset of the ids of the peers that have piece_id available."""
+        return self._state.holders_snapshot(piece_id)